@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+# Content-addressed store of rule outputs, shared between Themis runs on the same assemblies
+import os
+import sys
+import json
+import shutil
+import hashlib
+import argparse
+
+CHUNK = 1 << 20
+
+
+def parse_user_input():
+    parser = argparse.ArgumentParser(
+            description = "Restore rule outputs from, or store them in, a content-addressed cache directory"
+            )
+    parser.add_argument('action',
+                        help="restore: copy cached outputs into place, exit 1 on a miss; store: save outputs",
+                        type=str, choices=['restore', 'store']
+                        )
+    parser.add_argument('-c', '--cache',
+                        help="Cache directory",
+                        type=str, required=True
+                        )
+    parser.add_argument('-s', '--step',
+                        help="Name of the cached step (usually the rule name)",
+                        type=str, required=True
+                        )
+    parser.add_argument('-i', '--inputs',
+                        help="Files or directories whose content the outputs depend on",
+                        type=str, nargs='+', required=True
+                        )
+    parser.add_argument('-o', '--outputs',
+                        help="Output files or directories of the step",
+                        type=str, nargs='+', required=True
+                        )
+    parser.add_argument('-p', '--params',
+                        help="Parameter string that also changes the outputs [none]",
+                        type=str, default=''
+                        )
+
+    return parser.parse_args(), parser
+
+
+def file_digest(path, cache):
+    """
+    Hash of the content of a file, memoized in the cache directory by path, size and mtime
+    so unchanged multi-gigabyte fastas and reads are only read once
+    -----
+    Parameters :
+        path : (str) file to hash; symlinks are followed
+        cache : (str) cache directory
+    -----
+    Returns :
+        str : hex digest
+    """
+    real = os.path.realpath(path)
+    st = os.stat(real)
+    memo = os.path.join(cache, 'hashes', hashlib.sha1(real.encode()).hexdigest() + '.json')
+    stamp = [st.st_size, st.st_mtime_ns]
+    if os.path.exists(memo):
+        with open(memo) as fh:
+            saved = json.load(fh)
+        if saved['stamp'] == stamp:
+            return saved['digest']
+
+    h = hashlib.blake2b(digest_size=20)
+    with open(real, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(CHUNK), b''):
+            h.update(chunk)
+    digest = h.hexdigest()
+    _write_json(memo, {'path' : real, 'stamp' : stamp, 'digest' : digest})
+    return digest
+
+
+def path_digest(path, cache):
+    """ Hash of a file, or of the relative names and contents of every file under a directory """
+    if not os.path.isdir(path):
+        return file_digest(path, cache)
+    h = hashlib.blake2b(digest_size=20)
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for f in sorted(files):
+            full = os.path.join(root, f)
+            h.update(os.path.relpath(full, path).encode() + b'\0')
+            h.update(file_digest(full, cache).encode())
+    return h.hexdigest()
+
+
+def cache_key(step, inputs, outputs, params, cache):
+    """
+    Key of a cache entry: the step, its parameters, the content of every input and the output
+    paths, which are part of the key because some tools write the assembly name into their results
+    """
+    h = hashlib.blake2b(digest_size=20)
+    h.update(json.dumps([step, params, outputs]).encode())
+    for i in inputs:
+        h.update(path_digest(i, cache).encode())
+    return h.hexdigest()
+
+
+def _write_json(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'w') as out:
+        json.dump(data, out)
+    os.replace(tmp, path)
+
+
+def _copy(src, dst):
+    # Never hard link: an output rewritten in place would silently change the cache entry with it.
+    # copy_file_range lets filesystems that support it share extents (reflink) instead of copying bytes
+    with open(src, 'rb') as i, open(dst, 'wb') as o:
+        try:
+            remaining = os.fstat(i.fileno()).st_size
+            while remaining > 0:
+                n = os.copy_file_range(i.fileno(), o.fileno(), remaining)
+                if n == 0:
+                    break
+                remaining -= n
+        except (AttributeError, OSError):
+            i.seek(0)
+            o.seek(0)
+            o.truncate()
+            shutil.copyfileobj(i, o, CHUNK)
+    return dst
+
+
+def _place(src, dst):
+    if os.path.isdir(src):
+        shutil.copytree(src, dst, copy_function=_copy, symlinks=True)
+    else:
+        _copy(src, dst)
+
+
+def _protect(path):
+    # Cache entries are read-only so nothing can modify them by accident
+    if os.path.isdir(path):
+        for root, dirs, files in os.walk(path):
+            for f in files:
+                full = os.path.join(root, f)
+                if not os.path.islink(full):
+                    os.chmod(full, 0o444)
+    elif not os.path.islink(path):
+        os.chmod(path, 0o444)
+
+
+def _remove(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.remove(path)
+
+
+def _touch(path):
+    # Restored outputs must look newer than this run's inputs to the scheduler
+    if os.path.isdir(path):
+        for root, dirs, files in os.walk(path, topdown=False):
+            for f in files:
+                os.utime(os.path.join(root, f))
+            os.utime(root)
+    else:
+        os.utime(path)
+
+
+def restore(entry, outputs):
+    """ Put the outputs of a cache entry in place; returns False on a miss """
+    if not os.path.exists(os.path.join(entry, 'manifest.json')):
+        return False
+    for i, o in enumerate(outputs):
+        _remove(o)
+        if os.path.dirname(o):
+            os.makedirs(os.path.dirname(o), exist_ok=True)
+        _place(os.path.join(entry, str(i)), o)
+        _touch(o)
+    return True
+
+
+def store(entry, step, inputs, outputs, params):
+    """ Save outputs as a new cache entry; the entry only becomes visible once complete """
+    if os.path.exists(os.path.join(entry, 'manifest.json')):
+        return
+    tmp = f'{entry}.{os.getpid()}.tmp'
+    _remove(tmp)
+    os.makedirs(tmp)
+    for i, o in enumerate(outputs):
+        _place(o, os.path.join(tmp, str(i)))
+        _protect(os.path.join(tmp, str(i)))
+    _write_json(os.path.join(tmp, 'manifest.json'),
+        {'step' : step, 'params' : params, 'inputs' : [os.path.realpath(i) for i in inputs], 'outputs' : outputs})
+    try:
+        os.rename(tmp, entry)
+    except OSError:
+        # Another job stored the same entry first
+        shutil.rmtree(tmp)
+
+
+def main(args, parser):
+    key = cache_key(args.step, args.inputs, args.outputs, args.params, args.cache)
+    entry = os.path.join(args.cache, args.step, key)
+    if args.action == 'restore':
+        if not restore(entry, args.outputs):
+            print(f'No cached {args.step} results for key {key}', file=sys.stderr)
+            sys.exit(1)
+        print(f'Restored {args.step} results from {entry}', file=sys.stderr)
+    else:
+        store(entry, args.step, args.inputs, args.outputs, args.params)
+        print(f'Stored {args.step} results in {entry}', file=sys.stderr)
+
+if __name__ == "__main__":
+    args, parser = parse_user_input()
+    main(args, parser)
@@ -1,16 +1,19 @@
 # Originally by Mike Schatz, modified by Maria Nattestad and translated to a hipster language by Derek Bickhart!
 # github.com/marianattestad/assemblytics
 import os
+import sys
 import argparse
-from collections import defaultdict
+from multiprocessing import Pool
+import numpy as np
+import paf_table
 
 def parse_user_input():
     parser = argparse.ArgumentParser(
             description = "Generate between paf alignment statistics"
             )
     parser.add_argument('-f', '--file',
-                        help="A single PAF alignment file between two assemblies.",
-                        type=str, required=True
+                        help="A PAF alignment file between two assemblies; '-' reads stdin. Repeat with -o to process several pairs in one batch",
+                        action="append", required=True
                         )
     parser.add_argument('-m', '--minimum',
                         help="Minimum event size to filter",
@@ -29,169 +32,173 @@ def parse_user_input():
                         type=int, default=100000
                         )
     parser.add_argument('-o', '--output',
-                        help="Output file Name",
-                        type=str, required=True
+                        help="Output file Name. Add in the order in which the -f option is specified",
+                        action="append", required=True
+                        )
+    parser.add_argument('-s', '--stream',
+                        help="Stream a query-grouped PAF (eg. piped from minimap2) and write SVs as each query block completes. SVs are written in input query order",
+                        action='store_true', default=False
+                        )
+    parser.add_argument('-t', '--threads',
+                        help="Number of PAF files to process in parallel in batch mode",
+                        type=int, default=1
+                        )
+    parser.add_argument('-S', '--summary',
+                        help="Optional output table of SV counts by type for every PAF file",
+                        type=str, default=None
                         )
 
     return parser.parse_args(), parser
 
-class pafLine:
-
-    def __init__(self, line):
-        segs = line.rstrip().split()
-        if len(segs) < 12:
-            self.valid = False
-            # to allow filtration of malformed lines later
-            return
-
-        # Essential attributes
-        self.valid = True
-        self.rstart = int(segs[7])
-        self.rend = int(segs[8])
-        self.qstart = int(segs[2])
-        self.qend = int(segs[3])
-        self.rlen = int(segs[6])
-        self.qlen = int(segs[1])
-        self.rid = segs[5]
-        self.qid = segs[0]
-        self.qidx = 0
-        self.qrc = True if segs[4] == '-' else False
-
-    def getqlen(self):
-        return self.qend - self.qstart
-
-    def getrlen(self):
-        return self.rend - self.rstart
-
-class pafComp:
-
-    def __init__(self, prev, curr):
-        self.prev = prev
-        self.curr = curr
-        self.rdist = 0
-        self.qdist = 0
-        self.positions = []
-        self.totdist = 0
-        self.svtype = ""
-        self.typeguess = ""
-        self.abs_size = 0
-
-    def compareOrient(self):
-        if not self.prev.qrc and not self.curr.qrc:
-            self.svtype = "FF"
-            self.qdist = self.curr.qstart - self.prev.qend
-            self.rdist = self.curr.rstart - self.prev.rend
-            self.positions = [self.prev.rend, self.curr.rstart]
-        elif self.prev.qrc and self.curr.qrc:
-            self.svtype = "RR"
-            self.qdist = self.prev.rstart - self.curr.rend
-            self.rdist = self.curr.qend - self.prev.qstart
-            self.positions = [self.prev.rstart, self.curr.rend]
-        elif not self.prev.qrc and self.curr.qrc:
-            self.svtype = "FR"
-            self.qdist = self.curr.qend - self.prev.qend
-            self.rdist = self.curr.rstart - self.prev.rend
-            self.positions = [self.prev.rend, self.curr.rend]
-        elif self.prev.qrc and not self.curr.qrc:
-            self.svtype = "RF"
-            self.qdist = self.prev.qend - self.curr.qend
-            self.rdist = self.curr.rstart - self.prev.rend
-            self.positions = [self.prev.rstart, self.curr.rstart]
+# SV type labels; classify() returns indices into this table
+SVTYPES = np.array(["None", "Interchromosomal", "Inversion", "Insertion", "Tandem_expansion",
+    "Repeat_expansion", "Deletion", "Tandem_contraction", "Repeat_contraction", "Longrange"])
+NONE, INTER, INV, INS, TEXP, REXP, DEL, TCON, RCON, LONG = range(len(SVTYPES))
+
+def sort_alignments(table):
+    """
+    Order alignments by query name, then query start. Ties keep the order of
+    sorted target names and then file order, as the per-query loop did.
+    """
+    rec = table.records
+    return rec[np.lexsort((np.arange(len(rec)), table.trank()[rec['tid']], rec['qstart'], table.qrank()[rec['qid']]))]
+
+def sort_query_blocks(table):
+    """
+    Order a batch of complete, query-grouped alignments like sort_alignments,
+    but keep queries in input order so batches can be written as they arrive
+    """
+    rec = table.records
+    # Rank only the targets present in this batch; relative order is all the sort needs
+    tids, inv = np.unique(rec['tid'], return_inverse=True)
+    rank = np.empty(len(tids), dtype=np.int64)
+    rank[np.argsort(np.asarray([table.tnames[t] for t in tids.tolist()], dtype=str), kind='stable')] = np.arange(len(tids))
+    return rec[np.lexsort((np.arange(len(rec)), rank[inv], rec['qstart'], rec['qid']))]
+
+def classify(rec, args):
+    """
+    Classify every pair of adjacent alignments of the same query at once
+    -----
+    Parameters :
+        rec : (numpy.ndarray) PAF records sorted by sort_alignments
+        args : (argparse.Namespace) minimum, maximum, narrow and qdist filters
+    -----
+    Returns :
+        dict : columns of the called SVs in output order (tid, start, end,
+        size, type, rdist, qdist)
+    """
+    prev = rec[:-1]
+    curr = rec[1:]
+    valid = (prev['qid'] == curr['qid']) & (prev['tend'] - prev['tstart'] >= args.minimum) & \
+        (curr['tend'] - curr['tstart'] >= args.minimum)
+    prev = prev[valid]
+    curr = curr[valid]
+
+    # Specify SV orientation
+    ff = ~prev['rc'] & ~curr['rc']
+    rr = prev['rc'] & curr['rc']
+    fr = ~prev['rc'] & curr['rc']
+    rf = prev['rc'] & ~curr['rc']
+    orient = [ff, rr, fr, rf]
+    qdist = np.select(orient, [curr['qstart'] - prev['qend'], prev['tstart'] - curr['tend'],
+        curr['qend'] - prev['qend'], prev['qend'] - curr['qend']])
+    rdist = np.select(orient, [curr['tstart'] - prev['tend'], curr['qend'] - prev['qstart'],
+        curr['tstart'] - prev['tend'], curr['tstart'] - prev['tend']])
+    pos1 = np.select(orient, [prev['tend'], prev['tstart'], prev['tend'], prev['tstart']])
+    pos2 = np.select(orient, [curr['tstart'], curr['tend'], curr['tend'], curr['tstart']])
+
+    # Guess SV type based on context
+    n = args.narrow
+    inter = prev['tid'] != curr['tid']
+    inv = fr | rf
+    expand = qdist > rdist
+    contract = qdist < rdist
+    svtype = np.select([inter, inv,
+        expand & (rdist > -n) & (rdist < n) & (qdist > -n), expand & ((rdist < 0) | (qdist < 0)), expand,
+        contract & (rdist > -n) & (qdist > -n) & (qdist < n), contract & ((rdist < 0) | (qdist < 0)), contract],
+        [INTER, INV, INS, TEXP, REXP, DEL, TCON, RCON], default=NONE)
+    size = np.where(~inter & inv, rdist, np.abs(rdist - qdist))
+    rdist = np.where(inter, 0, rdist)
+
+    longrange = size > args.maximum
+    svtype[longrange] = LONG
+    svtype[longrange & (np.abs(qdist) > args.qdist)] = NONE
+
+    # print out SV if it passes filter
+    keep = svtype != NONE
+    start = np.minimum(pos1, pos2)[keep]
+    end = np.maximum(pos1, pos2)[keep]
+    end = np.where(end == start, start + 1, end)
+    return {'tid' : prev['tid'][keep], 'start' : start, 'end' : end, 'size' : size[keep],
+        'type' : svtype[keep], 'rdist' : rdist[keep], 'qdist' : qdist[keep]}
+
+def write_calls(out, calls, tnames, svcounter):
+    """ Write classified SVs, numbering them from svcounter + 1; returns the last number used """
+    for tid, start, end, size, svtype, rdist, qdist in zip(calls['tid'].tolist(), calls['start'].tolist(),
+            calls['end'].tolist(), calls['size'].tolist(), calls['type'].tolist(), calls['rdist'].tolist(),
+            calls['qdist'].tolist()):
+        svcounter += 1
+        out.write(f'{tnames[tid]}\t{start}\t{end}\taqc_sv{svcounter}\t{size}\t+\t{SVTYPES[svtype]}\t{rdist}\t{qdist}\t-\tbetween\n')
+    return svcounter
+
+
+def call_variants(file, output, args):
+    """
+    Call between alignment SVs from one PAF file
+    -----
+    Parameters :
+        file : (str) PAF file name; '-' reads stdin
+        output : (str) output SV table
+        args : (argparse.Namespace) filters and the stream flag
+    -----
+    Returns :
+        numpy.ndarray : count of written SVs of each type, indexed like SVTYPES
+    """
+    counts = np.zeros(len(SVTYPES), dtype=np.int64)
+    with open(output, 'w') as out:
+        out.write("chrom\tstart\tstop\tname\tsize\tstrand\ttype\tref.dist\tquery.dist\tcontig_position\tmethod.found\n")
+        if args.stream:
+            # Only one batch of query blocks is held in memory at a time
+            input = sys.stdin if file == '-' else open(file, 'r')
+            svcounter = 0
+            for table in paf_table.iter_query_batches(input):
+                calls = classify(sort_query_blocks(table), args)
+                svcounter = write_calls(out, calls, table.tnames, svcounter)
+                counts += np.bincount(calls['type'], minlength=len(SVTYPES))
+            if input is not sys.stdin:
+                input.close()
         else:
-            self.svtype = "ER"
-        self.totdist = self.rdist + self.qdist
+            # Load data, zero-copy from the binary cache made by paf_table.py when there is one
+            table = paf_table.read_paf(sys.stdin) if file == '-' else paf_table.load_paf(file)
 
-    def guessType(self, args):
-        abs_event_size = abs(self.rdist - self.qdist)
-
-        if self.prev.rid != self.curr.rid:
-            self.typeguess = "Interchromosomal"
-            self.rdist = 0
-        else:
-            if self.svtype == "FR" or self.svtype == "RF":
-                self.typeguess = "Inversion"
-                abs_event_size = self.rdist
-            elif self.qdist > self.rdist:
-                if self.rdist > -1 * args.narrow and self.rdist < args.narrow and self.qdist > -1 * args.narrow:
-                    self.typeguess = "Insertion"
-                else:
-                    if self.rdist < 0 or self.qdist < 0:
-                        self.typeguess = "Tandem_expansion"
-                    else:
-                        self.typeguess = "Repeat_expansion"
-            elif self.qdist < self.rdist:
-                if self.rdist > -1 * args.narrow and self.qdist > -1 * args.narrow and self.qdist < args.narrow:
-                    self.typeguess = "Deletion"
-                else:
-                    if self.rdist < 0 or self.qdist < 0:
-                        self.typeguess = "Tandem_contraction"
-                    else:
-                        self.typeguess = "Repeat_contraction"
-            else:
-                self.typeguess = "None"
-        self.abs_size = abs_event_size
-
-        if self.abs_size > args.maximum:
-            self.typeguess = "Longrange"
-            if abs(self.qdist) > args.qdist:
-                self.typeguess = "None"
-
-    def isNone(self):
-        return True if self.typeguess == "None" else False
-
-    def getOutStr(self, counter):
-        ref_start = min(self.positions)
-        ref_end = max(self.positions)
-        ref_end = ref_start + 1 if ref_end == ref_start else ref_end
-        return f'{self.prev.rid}\t{ref_start}\t{ref_end}\taqc_sv{counter}\t{self.abs_size}\t+\t{self.typeguess}\t{self.rdist}\t{self.qdist}\t-\tbetween\n'
+            # start organization by query sequence
+            calls = classify(sort_alignments(table), args)
+            svcounter = write_calls(out, calls, table.tnames, 0)
+            counts += np.bincount(calls['type'], minlength=len(SVTYPES))
 
+    print(f'Identified {svcounter} between alignment SVs in {file}')
+    return counts
 
 def main(args, parser):
-    # Load data
-    pdata = defaultdict(lambda: defaultdict(list))
-    qids = set()
-    rids = set()
-    with open(args.file, 'r') as paf:
-        for l in paf:
-            temp = pafLine(l)
-            if temp.valid:
-                pdata[temp.qid][temp.rid].append(temp)
-                qids.add(temp.qid)
-                rids.add(temp.rid)
-
-    # start organization by query sequence
-    with open(args.output, 'w') as out:
-        svcounter = 0
-        out.write("chrom\tstart\tstop\tname\tsize\tstrand\ttype\tref.dist\tquery.dist\tcontig_position\tmethod.found\n")
-        for q in sorted(qids):
-            working = []
-            for r in sorted(rids):
-                if r in pdata[q]:
-                    working.extend(pdata[q][r])
-
-            working.sort(key=lambda x: x.qstart)
-
-            if len(working) > 1:
-                for i in range(1,len(working)):
-                    prev = working[i-1]
-                    curr = working[i]
-
-                    if prev.getrlen() >= args.minimum and curr.getrlen() >= args.minimum:
-                        # Create workhorse class
-                        comp = pafComp(prev, curr)
-
-                        # Specify SV orientation
-                        comp.compareOrient()
-
-                        # Guess SV type based on context
-                        comp.guessType(args)
-
-                        # print out SV if it passes filter
-                        if not comp.isNone():
-                            svcounter += 1
-                            out.write(comp.getOutStr(svcounter))
-
-    print(f'Identified {svcounter} between alignment SVs')
+    if len(args.file) != len(args.output):
+        parser.error(f'Please enter the same count of PAF files {len(args.file)} as output files {len(args.output)}')
+    if args.file.count('-') > 1:
+        parser.error('Only one PAF file can be read from stdin')
+
+    jobs = [(f, o, args) for f, o in zip(args.file, args.output)]
+    # Pool workers do not inherit stdin, so a piped PAF is always processed in this process
+    if args.threads > 1 and len(jobs) > 1 and '-' not in args.file:
+        # One worker per PAF file saves the interpreter startup and scheduling of a job per assembly pair
+        with Pool(processes=min(args.threads, len(jobs))) as pool:
+            counts = pool.starmap(call_variants, jobs)
+    else:
+        counts = [call_variants(*j) for j in jobs]
+
+    if args.summary is not None:
+        with open(args.summary, 'w') as out:
+            out.write('\t'.join(['file', 'total'] + SVTYPES[NONE + 1:].tolist()) + '\n')
+            for f, c in zip(args.file, counts):
+                out.write('\t'.join([f, str(c.sum())] + [str(x) for x in c[NONE + 1:].tolist()]) + '\n')
 
 if __name__ == "__main__":
     args, parser = parse_user_input()
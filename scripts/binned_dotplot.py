@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+# Fixed-resolution dotplots of PAF alignments rasterized into identity-weighted density matrices
+import argparse
+import numpy as np
+import fasta_index
+import paf_table
+
+
+def parse_user_input():
+    parser = argparse.ArgumentParser(
+            description = "Draw a binned dotplot of a PAF alignment file between two assemblies"
+            )
+    parser.add_argument('-p', '--paf',
+                        help="Input paf alignment file",
+                        type=str, required=True
+                        )
+    parser.add_argument('-r', '--reference',
+                        help="Reference (target) fasta file",
+                        type=str, required=True
+                        )
+    parser.add_argument('-q', '--query',
+                        help="Query fasta file",
+                        type=str, required=True
+                        )
+    parser.add_argument('-o', '--output',
+                        help="Output png file name",
+                        type=str, required=True
+                        )
+    parser.add_argument('-x', '--pixels',
+                        help="Bins along each axis of the density matrix [1000]",
+                        type=int, default=1000
+                        )
+    parser.add_argument('-m', '--minimum',
+                        help="Minimum alignment block length to plot [0]",
+                        type=int, default=0
+                        )
+
+    return parser.parse_args(), parser
+
+# Upper bounds of the identity classes used for colors, as in D-Genies
+IDENTITY_BREAKS = [0.25, 0.5, 0.75, 1.0]
+IDENTITY_COLORS = ['#ffc107', '#ff6f00', '#4caf50', '#094b09']
+
+
+def contig_offsets(index, names):
+    """
+    Genome-wide offsets of contigs laid end to end, largest contig first
+    -----
+    Parameters :
+        index : (fasta_index.FastaIndex) index of the assembly
+        names : (list) sequence names in the order of the PAF name table
+    -----
+    Returns :
+        numpy.ndarray : offset of every name in names; -1 for names missing from the index
+        int : total assembly length
+        list : (name, offset, length) of every contig in plot order
+    """
+    order = np.argsort(-index.lengths, kind='stable')
+    starts = np.zeros(len(order), dtype=np.int64)
+    starts[order] = np.cumsum(index.lengths[order]) - index.lengths[order]
+    lookup = dict(zip(index.names.tolist(), starts.tolist()))
+    offsets = np.array([lookup.get(n, -1) for n in names], dtype=np.int64)
+    layout = [(index.names[i], int(starts[i]), int(index.lengths[i])) for i in order.tolist()]
+    return offsets, int(index.lengths.sum()), layout
+
+
+def sample_alignments(rec, toffsets, qoffsets, xbin, ybin):
+    """
+    Sample every alignment along its diagonal at least twice per bin it
+    crosses, so the work depends on the binning and not on how many bases
+    were aligned
+    -----
+    Parameters :
+        rec : (numpy.ndarray) paf_table records
+        toffsets : (numpy.ndarray) genome offset of each target id
+        qoffsets : (numpy.ndarray) genome offset of each query id
+        xbin : (float) bases per bin along the target axis
+        ybin : (float) bases per bin along the query axis
+    -----
+    Returns :
+        numpy.ndarray : genome-wide target coordinate of every sample
+        numpy.ndarray : genome-wide query coordinate of every sample
+        numpy.ndarray : aligned bases represented by every sample
+        numpy.ndarray : identity of the alignment of every sample
+    """
+    rec = rec[(toffsets[rec['tid']] >= 0) & (qoffsets[rec['qid']] >= 0)]
+    tstart = toffsets[rec['tid']] + rec['tstart']
+    tspan = rec['tend'] - rec['tstart']
+    qstart = qoffsets[rec['qid']] + rec['qstart']
+    qspan = rec['qend'] - rec['qstart']
+    identity = rec['matches'] / np.maximum(rec['alnlen'], 1)
+
+    n = np.maximum(np.ceil(np.maximum(tspan / xbin, qspan / ybin) * 2).astype(np.int64), 1)
+    aln = np.repeat(np.arange(len(rec)), n)
+    step = np.arange(len(aln)) - np.repeat(np.cumsum(n) - n, n)
+    frac = (step + 0.5) / n[aln]
+    x = tstart[aln] + frac * tspan[aln]
+    # Reverse strand alignments run down the query axis
+    qfrac = np.where(rec['rc'][aln], 1 - frac, frac)
+    y = qstart[aln] + qfrac * qspan[aln]
+    return x, y, (np.maximum(tspan, qspan) / n)[aln], identity[aln]
+
+
+def density_matrix(rec, toffsets, qoffsets, tsize, qsize, xbins, ybins):
+    """
+    Rasterize alignments into a binned matrix
+    -----
+    Parameters :
+        rec : (numpy.ndarray) paf_table records
+        toffsets : (numpy.ndarray) genome offset of each target id
+        qoffsets : (numpy.ndarray) genome offset of each query id
+        tsize : (int) target genome length (x axis)
+        qsize : (int) query genome length (y axis)
+        xbins : (int) bins along the target axis
+        ybins : (int) bins along the query axis
+    -----
+    Returns :
+        numpy.ndarray : aligned bases in each bin, shape (ybins, xbins)
+        numpy.ndarray : identity-weighted aligned bases in each bin
+    """
+    xbin = max(tsize / xbins, 1)
+    ybin = max(qsize / ybins, 1)
+    x, y, bases, identity = sample_alignments(rec, toffsets, qoffsets, xbin, ybin)
+    cells = np.minimum((y / ybin).astype(np.int64), ybins - 1) * xbins + np.minimum((x / xbin).astype(np.int64), xbins - 1)
+    coverage = np.bincount(cells, weights=bases, minlength=xbins * ybins).reshape(ybins, xbins)
+    weighted = np.bincount(cells, weights=bases * identity, minlength=xbins * ybins).reshape(ybins, xbins)
+    return coverage, weighted
+
+
+def identity_classes(coverage, weighted):
+    """ Identity class of the mean identity of every bin, 1 to len(IDENTITY_BREAKS); 0 marks empty bins """
+    filled = coverage > 0
+    mean = np.zeros(coverage.shape)
+    mean[filled] = weighted[filled] / coverage[filled]
+    classes = np.minimum(np.searchsorted(IDENTITY_BREAKS, mean), len(IDENTITY_BREAKS) - 1) + 1
+    return np.where(filled, classes, 0).astype(np.uint8)
+
+
+def identity_image(coverage, weighted):
+    """ RGBA image of the mean identity class of every bin; empty bins are transparent """
+    from matplotlib.colors import to_rgba
+    colors = np.array([(0, 0, 0, 0)] + [to_rgba(c) for c in IDENTITY_COLORS])
+    return colors[identity_classes(coverage, weighted)]
+
+
+def draw_dotplot(image, tsize, qsize, tlayout, qlayout, output, maxlabels=40):
+    """ Save the binned dotplot with contig boundaries and labels for the largest contigs """
+    import matplotlib
+    matplotlib.use('Agg')
+    from matplotlib import pyplot as plt
+    from matplotlib.patches import Patch
+
+    fig, ax = plt.subplots(figsize=(12, 12))
+    ax.imshow(image, origin='lower', extent=[0, tsize, 0, qsize], aspect='auto', interpolation='nearest')
+    for layout, line, ticks, labels in ((tlayout, ax.axvline, ax.set_xticks, ax.set_xticklabels),
+            (qlayout, ax.axhline, ax.set_yticks, ax.set_yticklabels)):
+        for name, offset, length in layout[1:maxlabels]:
+            line(offset, color='#bbbbbb', linewidth=0.3)
+        ticks([offset + length / 2 for name, offset, length in layout[:maxlabels]])
+        labels([name for name, offset, length in layout[:maxlabels]], fontsize=6)
+    plt.setp(ax.get_xticklabels(), rotation=90)
+    ax.set_xlim(0, tsize)
+    ax.set_ylim(0, qsize)
+    ax.set_xlabel('Reference')
+    ax.set_ylabel('Query')
+    lower = [0] + IDENTITY_BREAKS[:-1]
+    ax.legend(handles=[Patch(color=c, label=f'{int(l * 100)}-{int(u * 100)}% identity') for c, l, u in
+        zip(IDENTITY_COLORS, lower, IDENTITY_BREAKS)], loc='upper left', fontsize=8)
+    fig.savefig(output, dpi=150, bbox_inches='tight')
+    plt.close(fig)
+
+
+def main(args, parser):
+    table = paf_table.load_paf(args.paf)
+    rec = table.records
+    rec = rec[rec['alnlen'] >= args.minimum]
+
+    toffsets, tsize, tlayout = contig_offsets(fasta_index.load_index(args.reference), table.tnames)
+    qoffsets, qsize, qlayout = contig_offsets(fasta_index.load_index(args.query), table.qnames)
+    coverage, weighted = density_matrix(rec, toffsets, qoffsets, tsize, qsize, args.pixels, args.pixels)
+    draw_dotplot(identity_image(coverage, weighted), tsize, qsize, tlayout, qlayout, args.output)
+    print(f'Plotted {len(rec)} alignments into {args.pixels} x {args.pixels} bins')
+
+if __name__ == "__main__":
+    args, parser = parse_user_input()
+    main(args, parser)
@@ -7,6 +7,7 @@ __license__ = "MIT"
 
 from snakemake.shell import shell
 from os import path
+from subprocess import CalledProcessError
 
 log = snakemake.log_fmt_shell(stdout=True, stderr=True)
 extra = snakemake.params.get("extra", "")
@@ -19,14 +20,21 @@ assert lineage is not None, "please input the path to a lineage for busco assess
 outdir = path.dirname(snakemake.output[0])
 out_name = "btemp_" + snakemake.params.get("asm", "t")
 
-# note: --force allows snakemake to handle rewriting files as necessary
-# without needing to specify *all* busco outputs as snakemake outputs
-shell(
-    "busco --in {snakemake.input[1]} --out {out_name} --force "
-    " --cpu {snakemake.threads} --mode {mode} --lineage {lineage} "
-    " {extra} {log}"
-)
+# optional artifact cache commands; without them every run computes busco
+restore = snakemake.params.get("restore", "false")
+store = snakemake.params.get("store", "true")
+try:
+    shell("{restore} -i {snakemake.input[1]} -o {snakemake.output[0]}")
+except CalledProcessError:
+    # note: --force allows snakemake to handle rewriting files as necessary
+    # without needing to specify *all* busco outputs as snakemake outputs
+    shell(
+        "busco --in {snakemake.input[1]} --out {out_name} --force "
+        " --cpu {snakemake.threads} --mode {mode} --lineage {lineage} "
+        " {extra} {log}"
+    )
 
-# move to intended location
-shell("cp {out_name}/short_summary*.txt {outdir}/busco_summary.txt")
-shell("rm -rf {out_name}")
+    # move to intended location
+    shell("cp {out_name}/short_summary*.txt {outdir}/busco_summary.txt")
+    shell("rm -rf {out_name}")
+    shell("{store} -i {snakemake.input[1]} -o {snakemake.output[0]}")
@@ -1,49 +1,136 @@
-import subprocess as sp
+import argparse
+import mmap
 import numpy as np
 import os
 import sys
+import fasta_index
+import contiguity
 
-usage = f'python {sys.argv[0]} <BED of gap regions> <Fasta index file> <Output tab file name>'
+def parse_user_input():
+    parser = argparse.ArgumentParser(
+            description = "Split scaffolds at runs of N bases and calculate contig statistics"
+            )
+    parser.add_argument('-f', '--fasta',
+                        help="The input scaffold fasta file",
+                        type=str, required=True
+                        )
+    parser.add_argument('-o', '--output',
+                        help="Output tab file name",
+                        type=str, required=True
+                        )
+    parser.add_argument('-g', '--gap',
+                        help="Minimum length of a run of Ns to count as a gap [1]",
+                        type=int, default=1
+                        )
+    parser.add_argument('-b', '--bed',
+                        help="Optional output bed file of gap regions",
+                        type=str, default=None
+                        )
 
-if len(sys.argv) != 4:
-    print(usage)
-    sys.exit(-1)
+    return parser.parse_args(), parser
 
+# Bases per chunk when scanning a sequence; bounds memory on chromosome-scale scaffolds
+CHUNK_BASES = 1 << 24
 
+def find_gaps(mm, offset, length, linebases, linewidth):
+    """
+    Find runs of N/n bases in one sequence of a memory mapped fasta
+    -----
+    Parameters :
+        mm : (mmap.mmap) memory mapped fasta file
+        offset : (int) byte offset of the first base from the .fai
+        length : (int) sequence length from the .fai
+        linebases : (int) bases per line from the .fai
+        linewidth : (int) bytes per line from the .fai
+    -----
+    Returns :
+        numpy.ndarray : gap starts (0-based)
+        numpy.ndarray : gap ends (exclusive)
+    """
+    gstarts = []
+    gends = []
+    openstart = -1
+    chunklines = max(1, CHUNK_BASES // linebases)
+    for c0 in range(0, length, chunklines * linebases):
+        bases = min(chunklines * linebases, length - c0)
+        nlines = -(-bases // linebases)
+        start = offset + (c0 // linebases) * linewidth
+        # The last line of the file may not end in a newline
+        raw = np.frombuffer(mm, dtype=np.uint8, count=min(nlines * linewidth, len(mm) - start), offset=start)
+        # Drop the newline bytes at the end of every line without copying the chunk twice
+        full = bases // linebases
+        if len(raw) < full * linewidth:
+            # Last line of the file is a full line without its newline; pad it so the rows reshape
+            raw = np.concatenate([raw, np.zeros(full * linewidth - len(raw), dtype=np.uint8)])
+        seq = raw[:full * linewidth].reshape(full, linewidth)[:, :linebases].ravel()
+        if bases > full * linebases:
+            seq = np.concatenate([seq, raw[full * linewidth:full * linewidth + bases - full * linebases]])
+        isn = (seq | 0x20) == ord('n')
 
-# create chromosome length bed file
-with open(sys.argv[2], 'r') as fai, open(sys.argv[2] + '.bed', 'w') as out:
-    for l in fai:
-        s = l.rstrip().split()
-        out.write(f'{s[0]}\t1\t{s[1]}\n')
+        d = np.diff(isn.astype(np.int8), prepend=np.int8(0), append=np.int8(0))
+        starts = np.flatnonzero(d == 1) + c0
+        ends = np.flatnonzero(d == -1) + c0
+        # Join runs that continue across the chunk boundary
+        if openstart >= 0:
+            if isn[0]:
+                starts[0] = openstart
+            else:
+                gstarts.append(np.array([openstart]))
+                gends.append(np.array([c0]))
+            openstart = -1
+        if isn[-1]:
+            openstart = starts[-1]
+            starts = starts[:-1]
+            ends = ends[:-1]
+        gstarts.append(starts)
+        gends.append(ends)
+    if openstart >= 0:
+        gstarts.append(np.array([openstart]))
+        gends.append(np.array([length]))
+    if len(gstarts) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    return np.concatenate(gstarts).astype(np.int64), np.concatenate(gends).astype(np.int64)
 
-# define some Variables
-sizes = []
+def contig_lengths(length, gstarts, gends):
+    """
+    Lengths of the contigs left after removing sorted gaps from a sequence
+    """
+    cstarts = np.concatenate([[0], gends])
+    cends = np.concatenate([gstarts, [length]])
+    lens = cends - cstarts
+    return lens[lens > 0]
 
-# Run bedtools subtraction and process output
-cmd = ['bedtools', 'subtract', '-b', sys.argv[1], '-a', f'{sys.argv[2]}.bed']
-result = sp.run(cmd, stdout=sp.PIPE ).stdout.decode('utf-8')
-for l in result.split('\n'):
-    s = l.rstrip().split()
-    if len(s) < 3:
-        break
-    sizes.append(int(s[2]) - int(s[1]))
+def main(args, parser):
+    index = fasta_index.load_index(args.fasta)
 
-# calculate final values and print output
-sizes.sort(reverse=True)
+    sizes = []
+    bed = open(args.bed, 'w') if args.bed is not None else None
+    with open(args.fasta, 'rb') as input:
+        mm = mmap.mmap(input.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(args.fasta) > 0 else b''
+        for name, length, offset, linebases, linewidth in zip(index.names.tolist(), index.lengths.tolist(),
+                index.offsets.tolist(), index.linebases.tolist(), index.linewidths.tolist()):
+            if length == 0:
+                continue
+            gstarts, gends = find_gaps(mm, offset, length, linebases, linewidth)
+            keep = (gends - gstarts) >= args.gap
+            gstarts = gstarts[keep]
+            gends = gends[keep]
+            if bed is not None:
+                for s, e in zip(gstarts.tolist(), gends.tolist()):
+                    bed.write(f'{name}\t{s}\t{e}\n')
+            sizes.append(contig_lengths(length, gstarts, gends))
+        if len(mm) > 0:
+            mm.close()
+    if bed is not None:
+        bed.close()
 
-count = len(sizes)
-sum = np.sum(sizes) if count > 0 else 0
-mean = np.mean(sizes) if count > 0 else 0
-median = np.median(sizes) if count > 0 else 0
-stdev = np.std(sizes) if count > 0 else 0
+    # calculate final values and print output
+    sizes = np.concatenate(sizes) if len(sizes) > 0 else np.zeros(0, dtype=np.int64)
+    stats = contiguity.summary_stats(sizes)
+    with open(args.output, 'w') as out:
+        out.write("Num\tSumBp\tMeanBp\tMedianBp\tStdevBp\tContigN50\n")
+        out.write('{Num}\t{SumBp}\t{MeanBp}\t{MedianBp}\t{StdevBp}\t{N50}\n'.format(**stats))
 
-l50v = int(sum / 2)
-csum = np.cumsum(sizes)
-l50idx = min(csum[csum >= l50v])
-c50idx = np.where(csum == l50idx)
-
-n50 = sizes[int(c50idx[0])]
-with open(sys.argv[3], 'w') as out:
-    out.write("Num\tSumBp\tMeanBp\tMedianBp\tStdevBp\tContigN50\n")
-    out.write(f'{count}\t{sum}\t{mean}\t{median}\t{stdev}\t{n50}\n')
+if __name__ == "__main__":
+    args, parser = parse_user_input()
+    main(args, parser)
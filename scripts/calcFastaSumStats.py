@@ -1,39 +1,23 @@
 # This script is designed to run on a snakemake pipeline.
 import numpy as np
-from snakemake.shell import shell
+import fasta_index
+import contiguity
 #from collections import defaultdict
 
 #data = defaultdict(list)
 f = snakemake.input[0]
-fai = f + '.fai'
-shell("samtools faidx {f}")
 
-with open(snakemake.output[0], 'w') as out:
-    out.write("Num\tSumBp\tMeanBp\tMedianBp\tStdevBp\tContigN50\n")
-
-    sizes = list()
-
-    # Now read file and store fasta length lists
-    with open(fai, "r") as input:
-        for l in input:
-            l = l.rstrip()
-            lsegs = l.split()
-            sizes.append(int(lsegs[1]))
+genome_size = snakemake.params.get("genome_size", 0)
 
-    sizes.sort(reverse=True)
-
-    # Calculate stats and print
-    count = len(sizes)
-    sum = np.sum(sizes) if count > 0 else 0
-    mean = np.mean(sizes) if count > 0 else 0
-    median = np.median(sizes) if count > 0 else 0
-    stdev = np.std(sizes) if count > 0 else 0
+with open(snakemake.output[0], 'w') as out:
+    out.write("Num\tSumBp\tMeanBp\tMedianBp\tStdevBp\tContigN50\tContigL50\tContigNG50\tContigLG50\n")
 
-    l50v = int(sum / 2)
-    csum = np.cumsum(sizes)
-    l50idx = min(csum[csum >= l50v])
-    c50idx = np.where(csum == l50idx)
+    # Index the fasta in process and load the cached length array
+    sizes = fasta_index.load_index(f).lengths
 
-    n50 = sizes[int(c50idx[0])]
+    # Calculate stats and print; NG50 is undefined without an expected genome size
+    stats = contiguity.summary_stats(sizes, genome_size)
+    stats.setdefault('NG50', 'NA')
+    stats.setdefault('LG50', 'NA')
 
-    out.write(f'{count}\t{sum}\t{mean}\t{median}\t{stdev}\t{n50}\n')
+    out.write('{Num}\t{SumBp}\t{MeanBp}\t{MedianBp}\t{StdevBp}\t{N50}\t{L50}\t{NG50}\t{LG50}\n'.format(**stats))
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# Resumable checkpoints for the long per-contig loops in the pipeline scripts
+import os
+import json
+
+
+class Checkpoint:
+    """
+    Append-only log of finished work units (contigs, regions, queries...)
+    kept next to a script's final output. Each record is one JSON line so a
+    preempted job loses at most the unit it was working on. The first line
+    stores a signature of the inputs and settings; a log written with a
+    different signature is discarded instead of being resumed.
+
+    Usage :
+        ckpt = Checkpoint(output + '.ckpt', {'input' : input, 'threshold' : 3})
+        for ctg in contigs:
+            if ctg in ckpt:
+                value = ckpt.get(ctg)
+            else:
+                value = work(ctg)
+                ckpt.record(ctg, value)
+        ckpt.remove()
+    """
+
+    def __init__(self, path, signature):
+        self.path = path
+        self.signature = signature
+        self.completed = dict()
+
+        if not self._load():
+            with open(self.path, 'w') as out:
+                out.write(json.dumps({'signature' : self.signature}) + '\n')
+        self.handle = open(self.path, 'a')
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return False
+        valid = 0
+        with open(self.path, 'rb') as input:
+            header = input.readline()
+            try:
+                if json.loads(header)['signature'] != json.loads(json.dumps(self.signature)):
+                    return False
+            except (ValueError, KeyError):
+                return False
+            valid = len(header)
+            for l in input:
+                # A job killed mid-write leaves a partial last line
+                if not l.endswith(b'\n'):
+                    break
+                try:
+                    entry = json.loads(l)
+                except ValueError:
+                    break
+                self.completed[entry['key']] = entry['value']
+                valid += len(l)
+        # Drop any partial record so that new records start on a fresh line
+        os.truncate(self.path, valid)
+        return True
+
+    def __contains__(self, key):
+        return key in self.completed
+
+    def __len__(self):
+        return len(self.completed)
+
+    def get(self, key):
+        return self.completed[key]
+
+    def record(self, key, value):
+        self.completed[key] = value
+        self.handle.write(json.dumps({'key' : key, 'value' : value}) + '\n')
+        self.handle.flush()
+        os.fsync(self.handle.fileno())
+
+    def close(self):
+        if not self.handle.closed:
+            self.handle.close()
+
+    def remove(self):
+        """ Delete the log once the final output has been written """
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# Vectorized N(x)/NG(x)/L(x)/LG(x) contiguity statistics shared by the assembly summary scripts
+import numpy as np
+
+
+def sorted_lengths(lengths):
+    """ Sequence lengths as an int64 array sorted from largest to smallest """
+    return np.sort(np.asarray(lengths, dtype=np.int64))[::-1]
+
+
+def nx_value(lengths, x, genome_size=None):
+    """
+    N(x) and L(x) of an assembly: the length of the contig at which the
+    running sum of the largest contigs first reaches x percent of the
+    assembly (or, for NG(x)/LG(x), of the expected genome size) and the
+    number of contigs needed to get there
+    -----
+    Parameters :
+        lengths : (numpy.ndarray) contig lengths sorted from largest to smallest
+        x : (int) percentage of the assembly or genome
+        genome_size : (int) expected genome size for NG(x) [assembly length]
+    -----
+    Returns :
+        int : N(x) or NG(x); 0 if the assembly is too short to reach it
+        int : L(x) or LG(x); 0 if the assembly is too short to reach it
+    """
+    csum = np.cumsum(lengths)
+    total = int(csum[-1]) if len(csum) > 0 else 0
+    size = total if not genome_size else int(genome_size)
+    idx = int(np.searchsorted(csum, size * x // 100))
+    if len(lengths) == 0 or idx >= len(lengths):
+        return 0, 0
+    return int(lengths[idx]), idx + 1
+
+
+def nx_curve(lengths, genome_size=None):
+    """
+    Full N(x) (or NG(x)) curve of an assembly as a step function
+    -----
+    Parameters :
+        lengths : (numpy.ndarray) contig lengths sorted from largest to smallest
+        genome_size : (int) expected genome size for NG(x) [assembly length]
+    -----
+    Returns :
+        numpy.ndarray : percent of the assembly or genome in larger contigs, for each contig
+        numpy.ndarray : contig lengths
+        numpy.ndarray : L(x) count of contigs needed to reach each point
+    """
+    csum = np.cumsum(lengths)
+    total = int(csum[-1]) if len(csum) > 0 else 0
+    size = total if not genome_size else int(genome_size)
+    x = (csum - lengths) / max(size, 1) * 100
+    return x, lengths, np.arange(1, len(lengths) + 1)
+
+
+def summary_stats(lengths, genome_size=None):
+    """
+    Summary statistics of one assembly
+    -----
+    Returns :
+        dict : Num, SumBp, MeanBp, MedianBp, StdevBp, N50, L50 and, when a
+        genome size is given, NG50 and LG50
+    """
+    lengths = sorted_lengths(lengths)
+    count = len(lengths)
+    stats = {
+        'Num' : count,
+        'SumBp' : np.sum(lengths) if count > 0 else 0,
+        'MeanBp' : np.mean(lengths) if count > 0 else 0,
+        'MedianBp' : np.median(lengths) if count > 0 else 0,
+        'StdevBp' : np.std(lengths) if count > 0 else 0,
+    }
+    stats['N50'], stats['L50'] = nx_value(lengths, 50)
+    if genome_size:
+        stats['NG50'], stats['LG50'] = nx_value(lengths, 50, genome_size)
+    return stats
+
+
+def assembly_curves(asm_lengths, genome_size=None):
+    """
+    NG(x) curves for several assemblies on a common genome size
+    -----
+    Parameters :
+        asm_lengths : (dict) assembly name -> contig lengths
+        genome_size : (int) expected genome size [length of the largest assembly]
+    -----
+    Returns :
+        dict : assembly name -> (percent of genome, contig lengths, L(x)) from nx_curve
+    """
+    lengths = {k : sorted_lengths(v) for k, v in asm_lengths.items()}
+    if not genome_size:
+        genome_size = max([int(v.sum()) for v in lengths.values()] + [0])
+    return {k : nx_curve(v, genome_size) for k, v in lengths.items()}
@@ -198,6 +198,10 @@ def parse_user_input():
                         help="Assembly label name",
                         action="append", default=[]
                         )
+    parser.add_argument('-r', '--reference',
+                        help="Assembly label that all others were compared to, if the comparisons were reference anchored",
+                        type=str, default=None
+                        )
 
     return parser.parse_args(), parser
 
@@ -208,7 +212,7 @@ def main(args, parser):
         sys.exit()
 
     # Create the main index html
-    mdlines = indexMd(args.fasta, args.assembly, args.combos, args.final)
+    mdlines = indexMd(args.fasta, args.assembly, args.combos, args.final, args.reference)
     createHtml(''.join(mdlines), "Themis-ASM Summary", args.output + ".html")
 
     # Now create sub htmls for comparison plots
@@ -259,7 +263,7 @@ def compMd(combo, assemblies, outbase, finalfolder):
     # Returns a list of all lines in the md file
     return mdlines
 
-def indexMd(fastas, assemblies, combos, finalfolder):
+def indexMd(fastas, assemblies, combos, finalfolder, reference=None):
     mdlines = list()
     mdlines.append('# Assembly Report')
     #mdlines.append('<p id="pex">')
@@ -364,6 +368,8 @@ def indexMd(fastas, assemblies, combos, finalfolder):
                     '<a name="asmcomp"></a>',
                     '## Assembly comparisons',
                     'The following links are to pairwise comparisons of each assembly to the other. These can be informative when comparing one assembly to a reference genome of the same organism. There may also be some value in comparing assemblies between different species or breeds.'])
+    if reference is not None:
+        mdlines.append(f'Each assembly was only compared to {reference}.')
 
     # Pair wise combination links
     for c in combos:
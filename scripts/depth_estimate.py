@@ -2,11 +2,22 @@ import os
 import sys
 import pysam
 import time
+import numpy as np
+from multiprocessing import Pool
+import depth_track
+from checkpoint import Checkpoint
+
+# unmapped, secondary, qc fail and duplicate reads
+SKIP_FLAGS = 0x4 | 0x100 | 0x200 | 0x400
+
+def open_alignments(input, reference=None):
+    """ Open a bam or cram file; the format is detected and cram records are decoded against the reference """
+    return pysam.AlignmentFile(input, 'r', reference_filename=reference)
 
 def get_chromosomes_names(input):
 
     # opening the bam file with pysam
-    bamfile = pysam.AlignmentFile(input, 'rb')
+    bamfile = open_alignments(input)
     # query all the names of  the chromosomes in a list
     list_chromosomes = bamfile.references
     list_length = bamfile.lengths
@@ -14,41 +25,322 @@ def get_chromosomes_names(input):
     return list_chromosomes, list_length
 
 
-def count_depth(chr_name, size, threshold, input):
+def split_regions(list_chrs, list_sizes, chunksize):
+    """
+    Split chromosomes into fixed size regions for the worker pool.
+    -----
+    Parameters :
+        list_chrs : (list) names of the chromosomes
+        list_sizes : (list) lengths of the chromosomes
+        chunksize : (int) maximum length of each region
+    -----
+    Returns :
+        list : (chr, start, end) tuples, largest regions first
+    """
+    regions = []
+    for chr, size in zip(list_chrs, list_sizes):
+        for start in range(0, size, chunksize):
+            regions.append((chr, start, min(start + chunksize, size)))
+    # Hand out the largest regions first so that workers finish together
+    regions.sort(key=lambda x: x[2] - x[1], reverse=True)
+    return regions
+
+
+def region_coverage(bamfile, chr_name, start, end):
+    """
+    Build the read depth of every base in a region from the alignment
+    coordinates with a difference array instead of a pileup.
+    -----
+    Parameters :
+        bamfile : (pysam.AlignmentFile) open alignment file
+        chr : (str) name of the chromosome
+        start : (int) 0-based start of the region
+        end : (int) 0-based end of the region
+    -----
+    Returns :
+        numpy.ndarray : depth of each base in the region
+    """
+    length = end - start
+    starts = []
+    ends = []
+    for read in bamfile.fetch(chr_name, start, end):
+        # Same reads that the default pileup() stepper and orphan filter discard
+        if read.flag & SKIP_FLAGS or (read.flag & 1 and not read.flag & 2):
+            continue
+        # pileup() counts reads spanning deletions and skips, so use the full CIGAR span
+        rend = read.reference_end
+        if rend is None:
+            continue
+        starts.append(read.reference_start)
+        ends.append(rend)
+
+    starts = np.clip(np.array(starts, dtype=np.int64) - start, 0, length)
+    ends = np.clip(np.array(ends, dtype=np.int64) - start, 0, length)
+    diff = np.bincount(starts, minlength=length + 1) - np.bincount(ends, minlength=length + 1)
+    return np.cumsum(diff[:length], dtype=np.int32)
+
+
+def count_depth(chr_name, start, end, threshold, window, input, reference=None):
     """
     Count the depth of the read. For each genomic coordinate return the
     number of reads
     -----
     Parameters :
         chr : (str) name of the chromosome
+        start : (int) 0-based start of the region to count
+        end : (int) 0-based end of the region to count
         threshold : (int) minimum value to count pileup
+        window : (int) size of the coverage track windows
     -----
     Returns :
         int : count of pileups above threshold
+        numpy.ndarray : count of bases at each depth
+        numpy.ndarray : sum of the depth in each window of the region
     """
-    bp = 0
-    bamfile = pysam.AlignmentFile(input, 'rb')
-    for pileupcolumn in bamfile.pileup(chr_name):
-        depth = pileupcolumn.nsegments
-        if depth >= threshold:
-            bp += 1
+    bamfile = open_alignments(input, reference)
+    depth = region_coverage(bamfile, chr_name, start, end)
     bamfile.close()
-    return bp
+    bp = int(np.count_nonzero(depth >= threshold))
+    hist = np.bincount(depth)
+    wsums = np.add.reduceat(depth, np.arange(0, end - start, window), dtype=np.int64)
+    return bp, hist, wsums
+
+
+def get_mapped_counts(input):
+    """
+    Mapped read counts of each chromosome from the bam index (idxstats)
+    """
+    bamfile = open_alignments(input)
+    if bamfile.is_cram:
+        # Cram indices hold no counts; samtools reads them from the flag and reference columns instead
+        bamfile.close()
+        mapped = dict()
+        for l in pysam.idxstats(input).split('\n'):
+            segs = l.split('\t')
+            if len(segs) >= 4 and segs[0] != '*':
+                mapped[segs[0]] = int(segs[2])
+        return mapped
+    mapped = {x.contig : x.mapped for x in bamfile.get_index_statistics()}
+    bamfile.close()
+    return mapped
+
+
+def sample_windows(list_chrs, list_sizes, mapped, window, samples, seed):
+    """
+    Draw a stratified random sample of windows for the approximate mode.
+    Chromosomes are stratified by their read density from the bam index
+    relative to the genome-wide density (log2 bins), and windows are
+    allocated to strata in proportion to their length. Chromosomes without
+    mapped reads are not sampled since their depth is known to be zero.
+    -----
+    Parameters :
+        mapped : (dict) chromosome name -> mapped read count
+        window : (int) window size
+        samples : (int) total number of windows to sample
+        seed : (int) random seed
+    -----
+    Returns :
+        list : strata dicts with total bp, total windows and sampled (chr, start, end) windows
+    """
+    sizes = np.array(list_sizes, dtype=np.int64)
+    reads = np.array([mapped.get(c, 0) for c in list_chrs], dtype=np.float64)
+    covered = (reads > 0) & (sizes > 0)
+    if not covered.any():
+        return []
+    density = reads / np.maximum(sizes, 1)
+    gdensity = reads[covered].sum() / sizes[covered].sum()
+    strata_ids = np.clip(np.floor(np.log2(np.maximum(density, 1e-12) / gdensity)), -4, 4).astype(np.int64)
+
+    rng = np.random.default_rng(seed)
+    nwins = -(-sizes // window)
+    strata = []
+    total_bp = sizes[covered].sum()
+    for h in np.unique(strata_ids[covered]):
+        members = np.flatnonzero(covered & (strata_ids == h))
+        hbp = sizes[members].sum()
+        hwins = nwins[members]
+        total = hwins.sum()
+        # At least two windows per stratum so that its variance can be estimated
+        n = int(min(total, max(2, round(samples * hbp / total_bp))))
+        picks = np.sort(rng.choice(total, size=n, replace=False))
+        owner = np.searchsorted(np.cumsum(hwins), picks, side='right')
+        offsets = picks - (np.cumsum(hwins) - hwins)[owner]
+        windows = []
+        for m, o in zip(members[owner], offsets):
+            start = int(o) * window
+            windows.append((list_chrs[m], start, min(start + window, int(sizes[m]))))
+        strata.append({'bp' : int(hbp), 'windows' : int(total), 'sampled' : windows})
+    return strata
+
+
+def stratified_estimate(strata, results, z=1.96):
+    """
+    Ratio estimate of bases above threshold from sampled windows with a
+    normal approximation confidence interval
+    -----
+    Parameters :
+        strata : (list) strata from sample_windows
+        results : (dict) (chr, start, end) -> (bp above threshold, depth histogram)
+        z : (float) normal quantile for the interval
+    -----
+    Returns :
+        float : estimate, float : lower bound, float : upper bound,
+        numpy.ndarray : estimated depth histogram of the sampled strata
+    """
+    est = 0.0
+    var = 0.0
+    hist = np.zeros(1, dtype=np.float64)
+    for h in strata:
+        lens = np.array([e - s for c, s, e in h['sampled']], dtype=np.float64)
+        above = np.array([results[w][0] for w in h['sampled']], dtype=np.float64)
+        ratio = above.sum() / lens.sum()
+        est += h['bp'] * ratio
+        n = len(lens)
+        N = h['windows']
+        if n > 1 and n < N:
+            resid = above - ratio * lens
+            var += N * N * (1 - n / N) * resid.var(ddof=1) / n
+        scale = h['bp'] / lens.sum()
+        for w in h['sampled']:
+            whist = results[w][1]
+            if len(whist) > len(hist):
+                hist = np.pad(hist, (0, len(whist) - len(hist)))
+            hist[:len(whist)] += whist * scale
+    half = z * np.sqrt(var)
+    return est, max(0.0, est - half), est + half, hist
+
+
+def count_region(region):
+    chr, start, end, threshold, window, input, reference = region
+    return (chr, start, end, *count_depth(chr, start, end, threshold, window, input, reference))
+
+
+def exact_depth(bam, reference, list_chrs, list_sizes, threshold, window, chunksize, threads, ckptfile):
+    """
+    Count bases above threshold over every base of the bam
+    -----
+    Returns :
+        int : count of bases above threshold
+        numpy.ndarray : count of bases at each depth
+        dict : chromosome name -> numpy.ndarray of window depth sums
+        Checkpoint : log of finished regions, to be removed once outputs are written
+    """
+    # Regions must hold whole windows so that window sums never straddle two workers
+    chunksize = max(window, chunksize // window * window)
+    regions = [(c, s, e, threshold, window, bam, reference) for c, s, e in split_regions(list_chrs, list_sizes, chunksize)]
+
+    print("Split chromosomes into {} regions of at most {} bp".format(len(regions), chunksize))
+
+    sum = 0
+    hist = np.zeros(1, dtype=np.int64)
+    wsums = {chr : np.zeros(-(-size // window), dtype=np.int64) for chr, size in zip(list_chrs, list_sizes)}
+
+    def add_region(chr, start, end, bp, rhist, rsums):
+        nonlocal sum, hist
+        sum += bp
+        if len(rhist) > len(hist):
+            hist = np.pad(hist, (0, len(rhist) - len(hist)))
+        hist[:len(rhist)] += rhist
+        wstart = start // window
+        wsums[chr][wstart:wstart + len(rsums)] = rsums
+
+    # Regions finished by a previous, interrupted run of this job are read back from the checkpoint
+    bamstat = os.stat(bam)
+    ckpt = Checkpoint(ckptfile,
+        {'bam' : bam, 'size' : bamstat.st_size, 'mtime' : bamstat.st_mtime,
+        'threshold' : threshold, 'window' : window, 'chunksize' : chunksize})
+    todo = []
+    for region in regions:
+        key = f'{region[0]}:{region[1]}-{region[2]}'
+        if key in ckpt:
+            bp, rhist, rsums = ckpt.get(key)
+            add_region(region[0], region[1], region[2], bp, np.array(rhist, dtype=np.int64), np.array(rsums, dtype=np.int64))
+        else:
+            todo.append(region)
+
+    print("Resuming with {} regions already counted".format(len(regions) - len(todo)))
+
+    with Pool(processes=threads) as pool:
+        for chr, start, end, bp, rhist, rsums in pool.imap_unordered(count_region, todo):
+            add_region(chr, start, end, bp, rhist, rsums)
+            ckpt.record(f'{chr}:{start}-{end}', [bp, rhist.tolist(), rsums.tolist()])
+            print(f'Finished with region: {chr}:{start}-{end}. {end - start} {sum}')
+
+    return sum, hist, wsums, ckpt
+
+
+def approximate_depth(bam, reference, list_chrs, list_sizes, threshold, window, samples, seed, threads):
+    """
+    Estimate bases above threshold from a stratified sample of windows.
+    Windows that were not sampled have a NaN mean in the coverage track.
+    -----
+    Returns :
+        float : estimate, float : lower bound, float : upper bound
+        numpy.ndarray : estimated count of bases at each depth
+        dict : chromosome name -> numpy.ndarray of window depth sums
+    """
+    mapped = get_mapped_counts(bam)
+    strata = sample_windows(list_chrs, list_sizes, mapped, window, samples, seed)
+    regions = [(c, s, e, threshold, window, bam, reference) for h in strata for c, s, e in h['sampled']]
+
+    print("Sampled {} windows from {} strata".format(len(regions), len(strata)))
+
+    wsums = {chr : np.full(-(-size // window), np.nan) for chr, size in zip(list_chrs, list_sizes)}
+    results = dict()
+    with Pool(processes=threads) as pool:
+        for chr, start, end, bp, rhist, rsums in pool.imap_unordered(count_region, regions):
+            results[(chr, start, end)] = (bp, rhist)
+            wsums[chr][start // window] = rsums[0]
+
+    est, low, high, hist = stratified_estimate(strata, results)
+
+    # Chromosomes without any mapped reads have zero depth throughout
+    for chr, size in zip(list_chrs, list_sizes):
+        if mapped.get(chr, 0) == 0:
+            wsums[chr][:] = 0
+            hist[0] += size
+    return est, low, high, np.rint(hist).astype(np.int64), wsums
 
 
 bam = snakemake.input["samples"]
+# Only needed to decode cram files
+reference = snakemake.input.get("ref", None)
 threshold = snakemake.params["threshold"]
-print(f'Starting depth estimate for bam: {bam} at threshold {threshold}')
-sum = 0
+window = snakemake.params.get("window", 10000)
+chunksize = snakemake.params.get("chunksize", 10000000)
+mode = snakemake.params.get("mode", "exact")
+threads = snakemake.threads
+print(f'Starting {mode} depth estimate for bam: {bam} at threshold {threshold} with {threads} threads')
 
 list_chrs, list_sizes = get_chromosomes_names(bam)
 
 print("Found {} chromosomes to count".format(len(list_chrs)))
 
+ckpt = None
+if mode == "approx":
+    est, low, high, hist, wsums = approximate_depth(bam, reference, list_chrs, list_sizes, threshold, window,
+        snakemake.params.get("samples", 2000), snakemake.params.get("seed", 0), threads)
+    print(f'Estimated total bases: {est:.0f} (95% CI {low:.0f} - {high:.0f})')
+    # qv_estimate.sh only reads the first column
+    with open(snakemake.output["samdepth"], 'w') as final:
+        final.write(f'{est:.0f}\t{low:.0f}\t{high:.0f}\n')
+else:
+    sum, hist, wsums, ckpt = exact_depth(bam, reference, list_chrs, list_sizes, threshold, window, chunksize, threads,
+        snakemake.output["samdepth"] + '.ckpt')
+    print(f'Total bases: {sum}')
+    with open(snakemake.output["samdepth"], 'w') as final:
+        final.write(f'{sum}\n')
+
+# Mean coverage of each window; the last window of a chromosome is usually shorter
+means = dict()
 for chr, size in zip(list_chrs, list_sizes):
-    sum += count_depth(chr, size, threshold, bam)
-    print(f'Finished with chr: {chr}. {size} {sum}')
+    wlens = np.full(len(wsums[chr]), window, dtype=np.int64)
+    if len(wlens) > 0:
+        wlens[-1] = size - (len(wlens) - 1) * window
+    means[chr] = wsums[chr] / wlens
+
+depth_track.write_histogram(hist, snakemake.output["hist"])
+depth_track.write_track(list_chrs, list_sizes, window, means, snakemake.output["track"], snakemake.output["index"])
 
-print(f'Total bases: {sum}')
-with open(snakemake.output["samdepth"], 'w') as final:
-    final.write(f'{sum}\n')
+if ckpt is not None:
+    ckpt.remove()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# Readers and writers for the depth histogram and windowed coverage track
+# written by depth_estimate.py so that later steps do not need the bam again
+import sys
+import numpy as np
+
+usage = f'python {sys.argv[0]} <depth histogram file> <minimum depth threshold>'
+
+
+def write_histogram(hist, output):
+    """
+    Write a depth histogram as a two column (depth, bases) text file
+    -----
+    Parameters :
+        hist : (numpy.ndarray) count of bases at each depth
+        output : (str) output file name
+    """
+    with open(output, 'w') as out:
+        out.write("depth\tbases\n")
+        for depth, count in enumerate(hist):
+            out.write(f'{depth}\t{count}\n')
+
+
+def load_histogram(input):
+    """
+    Read a depth histogram written by write_histogram
+    -----
+    Returns :
+        numpy.ndarray : count of bases at each depth
+    """
+    hist = np.loadtxt(input, dtype=np.int64, skiprows=1, ndmin=2)
+    counts = np.zeros(hist[:, 0].max() + 1 if len(hist) else 1, dtype=np.int64)
+    counts[hist[:, 0]] = hist[:, 1]
+    return counts
+
+
+def bases_above(hist, threshold):
+    """
+    Count the bases at or above a depth threshold from a histogram
+    """
+    return int(hist[threshold:].sum())
+
+
+def write_track(chrs, sizes, window, means, track, index):
+    """
+    Write per-window mean coverage as one flat float32 .npy array and a
+    small tab delimited index of where each chromosome starts in it
+    -----
+    Parameters :
+        chrs : (list) names of the chromosomes
+        sizes : (list) lengths of the chromosomes
+        window : (int) window size in bp
+        means : (dict) chromosome name -> numpy.ndarray of window means
+        track : (str) output .npy file name
+        index : (str) output index file name
+    """
+    offset = 0
+    with open(index, 'w') as out:
+        out.write("chrom\tlength\twindow\toffset\tcount\n")
+        for chr, size in zip(chrs, sizes):
+            count = len(means[chr])
+            out.write(f'{chr}\t{size}\t{window}\t{offset}\t{count}\n')
+            offset += count
+    if len(chrs) > 0:
+        values = np.concatenate([means[chr] for chr in chrs]).astype(np.float32)
+    else:
+        values = np.zeros(0, dtype=np.float32)
+    np.save(track, values)
+
+
+def load_track(track, index):
+    """
+    Memory map a windowed coverage track
+    -----
+    Returns :
+        dict : chromosome name -> (window size, numpy.ndarray of window means)
+    """
+    values = np.load(track, mmap_mode='r')
+    windows = dict()
+    with open(index, 'r') as input:
+        input.readline()
+        for l in input:
+            s = l.rstrip().split('\t')
+            offset = int(s[3])
+            windows[s[0]] = (int(s[2]), values[offset:offset + int(s[4])])
+    return windows
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print(usage)
+        sys.exit(-1)
+
+    print(bases_above(load_histogram(sys.argv[1]), int(sys.argv[2])))
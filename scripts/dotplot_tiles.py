@@ -0,0 +1,344 @@
+#!/usr/bin/env python3
+# Multi-resolution tile pyramid and offline html viewer for interactive binned dotplots
+import os
+import json
+import argparse
+import numpy as np
+import fasta_index
+import paf_table
+import binned_dotplot
+
+
+def parse_user_input():
+    parser = argparse.ArgumentParser(
+            description = "Create a zoomable, tiled interactive dotplot of a PAF alignment file between two assemblies"
+            )
+    parser.add_argument('-p', '--paf',
+                        help="Input paf alignment file",
+                        type=str, required=True
+                        )
+    parser.add_argument('-r', '--reference',
+                        help="Reference (target) fasta file",
+                        type=str, required=True
+                        )
+    parser.add_argument('-q', '--query',
+                        help="Query fasta file",
+                        type=str, required=True
+                        )
+    parser.add_argument('-o', '--output',
+                        help="Output html file name",
+                        type=str, required=True
+                        )
+    parser.add_argument('-t', '--tiles',
+                        help="Output directory for the tile images",
+                        type=str, required=True
+                        )
+    parser.add_argument('-z', '--levels',
+                        help="Maximum number of zoom levels [0: from the assembly length, see default_levels]",
+                        type=int, default=0
+                        )
+    parser.add_argument('-b', '--minbin',
+                        help="Stop adding zoom levels once a pixel covers fewer bases than this [1000]",
+                        type=int, default=1000
+                        )
+    parser.add_argument('-m', '--minimum',
+                        help="Minimum alignment block length to plot [0]",
+                        type=int, default=0
+                        )
+    parser.add_argument('-c', '--maxcontigs',
+                        help="Maximum number of contigs per assembly to draw boundaries for [5000]",
+                        type=int, default=5000
+                        )
+
+    return parser.parse_args(), parser
+
+# Pixels along each side of a tile
+TILE = 256
+# Deepest zoom level cap; a level has 4 times the tiles of the one above it
+MAX_LEVELS = 8
+
+
+def default_levels(size):
+    """
+    Zoom level cap for an assembly of this length: two more levels for every
+    fourfold increase in megabases, between 3 and MAX_LEVELS. The deepest
+    pixel then grows with the square root of the assembly length (about 2 kb
+    at 5 Mb, 20 kb at 200 Mb and 90 kb at 3 Gb), which keeps tile sets small
+    """
+    return int(min(max(np.ceil(np.log2(max(size, 1) / 1e6) / 2) + 2, 3), MAX_LEVELS))
+
+
+def level_count(tsize, qsize, levels, minbin):
+    """ Number of zoom levels before a pixel would cover fewer than minbin bases on both axes """
+    n = 1
+    while n < levels and max(tsize, qsize) / (TILE * 2 ** n) >= minbin:
+        n += 1
+    return n
+
+
+def write_level(rec, toffsets, qoffsets, tsize, qsize, z, outdir):
+    """
+    Rasterize one zoom level and write its non-empty tiles. Only bins that
+    hold alignments are ever materialized, so deep levels stay cheap.
+    -----
+    Parameters :
+        z : (int) zoom level; the level is TILE * 2^z pixels on each side
+        outdir : (str) tile directory; tiles go to outdir/z/x_y.png with y counted from the bottom
+    -----
+    Returns :
+        list : x_y keys of the written tiles
+    """
+    from PIL import Image
+    from matplotlib.colors import to_rgb
+    # Paletted tiles: index 0 is transparent, then one entry per identity class
+    palette = [0, 0, 0] + [int(v * 255) for c in binned_dotplot.IDENTITY_COLORS for v in to_rgb(c)]
+    side = TILE * 2 ** z
+    xbin = max(tsize / side, 1e-9)
+    ybin = max(qsize / side, 1e-9)
+    x, y, bases, identity = binned_dotplot.sample_alignments(rec, toffsets, qoffsets, xbin, ybin)
+    xi = np.minimum((x / xbin).astype(np.int64), side - 1)
+    yi = np.minimum((y / ybin).astype(np.int64), side - 1)
+    cells, inv = np.unique(yi * side + xi, return_inverse=True)
+    coverage = np.bincount(inv, weights=bases)
+    weighted = np.bincount(inv, weights=bases * identity)
+
+    # Group the occupied bins by tile
+    cy, cx = np.divmod(cells, side)
+    tiles = (cy // TILE) * (2 ** z) + cx // TILE
+    order = np.argsort(tiles, kind='stable')
+    bounds = np.flatnonzero(np.diff(tiles[order])) + 1
+    os.makedirs(os.path.join(outdir, str(z)), exist_ok=True)
+    keys = []
+    for group in np.split(order, bounds):
+        if len(group) == 0:
+            continue
+        ty, tx = divmod(int(tiles[group[0]]), 2 ** z)
+        tcov = np.zeros((TILE, TILE))
+        tw = np.zeros((TILE, TILE))
+        tcov[cy[group] % TILE, cx[group] % TILE] = coverage[group]
+        tw[cy[group] % TILE, cx[group] % TILE] = weighted[group]
+        # Image rows run top down while query coordinates run bottom up
+        image = Image.fromarray(binned_dotplot.identity_classes(tcov, tw)[::-1], mode='P')
+        image.putpalette(palette)
+        image.save(os.path.join(outdir, str(z), f'{tx}_{ty}.png'), transparency=0, compress_level=1)
+        keys.append(f'{tx}_{ty}')
+    return keys
+
+
+def main(args, parser):
+    table = paf_table.load_paf(args.paf)
+    rec = table.records
+    rec = rec[rec['alnlen'] >= args.minimum]
+
+    toffsets, tsize, tlayout = binned_dotplot.contig_offsets(fasta_index.load_index(args.reference), table.tnames)
+    qoffsets, qsize, qlayout = binned_dotplot.contig_offsets(fasta_index.load_index(args.query), table.qnames)
+
+    maxlevels = args.levels if args.levels > 0 else default_levels(max(tsize, qsize))
+    levels = level_count(tsize, qsize, maxlevels, args.minbin)
+    tiles = {}
+    for z in range(levels):
+        tiles[z] = write_level(rec, toffsets, qoffsets, tsize, qsize, z, args.tiles)
+        print(f'Level {z}: {len(tiles[z])} tiles')
+
+    manifest = {
+        'base' : os.path.relpath(args.tiles, os.path.dirname(os.path.abspath(args.output))),
+        'tile' : TILE,
+        'levels' : levels,
+        'tsize' : tsize,
+        'qsize' : qsize,
+        'tiles' : tiles,
+        'tcontigs' : [[str(n), o, l] for n, o, l in tlayout[:args.maxcontigs]],
+        'qcontigs' : [[str(n), o, l] for n, o, l in qlayout[:args.maxcontigs]],
+        'reference' : os.path.basename(args.reference),
+        'query' : os.path.basename(args.query),
+        'colors' : binned_dotplot.IDENTITY_COLORS,
+        'breaks' : binned_dotplot.IDENTITY_BREAKS,
+    }
+    # The manifest is inlined rather than fetched so the page works from file:// inside the zip
+    with open(args.output, 'w') as out:
+        out.write(VIEWER.replace('<MANIFEST_GOES_HERE>', json.dumps(manifest, separators=(',', ':'))))
+
+
+VIEWER = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>Interactive dotplot</title>
+<style>
+body { margin: 0; font-family: sans-serif; overflow: hidden; }
+#plot { display: block; cursor: crosshair; }
+#status { position: absolute; bottom: 0; left: 0; right: 0; height: 24px; line-height: 24px; padding: 0 8px;
+    background: #f4f4f4; border-top: 1px solid #ccc; font-size: 12px; }
+#legend { position: absolute; top: 8px; right: 8px; background: rgba(255,255,255,0.85); padding: 4px 8px;
+    font-size: 12px; border: 1px solid #ccc; }
+</style>
+</head>
+<body>
+<canvas id="plot"></canvas>
+<div id="legend"></div>
+<div id="status">Scroll to zoom, drag to pan, double click to reset</div>
+<script>
+var M = <MANIFEST_GOES_HERE>;
+var canvas = document.getElementById('plot');
+var ctx = canvas.getContext('2d');
+var statusBar = document.getElementById('status');
+var MARGIN = 60;
+var view = null;
+var images = {};
+var available = {};
+for (var z = 0; z < M.levels; z++) {
+    available[z] = {};
+    M.tiles[z].forEach(function (k) { available[z][k] = true; });
+}
+
+var legend = document.getElementById('legend');
+M.colors.forEach(function (c, i) {
+    var lo = i == 0 ? 0 : M.breaks[i - 1];
+    legend.innerHTML += '<div><span style="display:inline-block;width:12px;height:12px;background:' + c +
+        '"></span> ' + Math.round(lo * 100) + '-' + Math.round(M.breaks[i] * 100) + '% identity</div>';
+});
+
+function width() { return canvas.width - MARGIN; }
+function height() { return canvas.height - MARGIN; }
+
+function reset() {
+    view = { x0: 0, y0: 0, bx: M.tsize / width(), by: M.qsize / height() };
+    draw();
+}
+
+function resize() {
+    canvas.width = window.innerWidth;
+    canvas.height = window.innerHeight - 25;
+    if (view === null) { reset(); } else { draw(); }
+}
+
+function sx(gx) { return MARGIN + (gx - view.x0) / view.bx; }
+function sy(gy) { return height() - (gy - view.y0) / view.by; }
+
+function tile(z, k) {
+    var key = z + '/' + k;
+    if (!(key in images)) {
+        var img = new Image();
+        img.onload = function () { img.ready = true; draw(); };
+        img.src = M.base + '/' + z + '/' + k + '.png';
+        images[key] = img;
+    }
+    return images[key];
+}
+
+function level() {
+    // Finest level whose pixels are no larger than the screen pixels, on the more zoomed axis
+    var z = 0;
+    while (z < M.levels - 1 && Math.min(M.tsize / (M.tile * Math.pow(2, z)) / view.bx,
+            M.qsize / (M.tile * Math.pow(2, z)) / view.by) > 1) { z++; }
+    return z;
+}
+
+function drawTiles(z) {
+    var n = Math.pow(2, z);
+    var tw = M.tsize / n, th = M.qsize / n;
+    var x1 = Math.max(0, Math.floor(view.x0 / tw)), x2 = Math.min(n - 1, Math.floor((view.x0 + width() * view.bx) / tw));
+    var y1 = Math.max(0, Math.floor(view.y0 / th)), y2 = Math.min(n - 1, Math.floor((view.y0 + height() * view.by) / th));
+    for (var tx = x1; tx <= x2; tx++) {
+        for (var ty = y1; ty <= y2; ty++) {
+            var k = tx + '_' + ty;
+            var dx = sx(tx * tw), dy = sy((ty + 1) * th), dw = tw / view.bx, dh = th / view.by;
+            if (available[z][k] && tile(z, k).ready) {
+                ctx.drawImage(images[z + '/' + k], dx, dy, dw, dh);
+            } else if (z > 0) {
+                // Stretch the matching quarter of the parent tile until this one has loaded
+                var pk = (tx >> 1) + '_' + (ty >> 1);
+                var parent = available[z - 1][pk] ? tile(z - 1, pk) : null;
+                if (parent !== null && parent.ready) {
+                    var h = M.tile / 2;
+                    ctx.drawImage(parent, (tx & 1) * h, (1 - (ty & 1)) * h, h, h, dx, dy, dw, dh);
+                }
+            }
+        }
+    }
+}
+
+function drawContigs(contigs, vertical) {
+    ctx.strokeStyle = '#cccccc';
+    ctx.fillStyle = '#333333';
+    ctx.lineWidth = 0.5;
+    ctx.font = '11px sans-serif';
+    var scale = vertical ? view.bx : view.by;
+    contigs.forEach(function (c) {
+        var a = vertical ? sx(c[1]) : sy(c[1]);
+        var size = c[2] / scale;
+        if (size < 2) { return; }
+        ctx.beginPath();
+        if (vertical) { ctx.moveTo(a, 0); ctx.lineTo(a, height()); } else { ctx.moveTo(MARGIN, a); ctx.lineTo(canvas.width, a); }
+        ctx.stroke();
+        if (size > 30) {
+            var mid = vertical ? sx(c[1] + c[2] / 2) : sy(c[1] + c[2] / 2);
+            ctx.save();
+            if (vertical) {
+                if (mid < MARGIN || mid > canvas.width) { ctx.restore(); return; }
+                ctx.translate(mid, height() + 4);
+                ctx.rotate(Math.PI / 4);
+            } else {
+                if (mid < 0 || mid > height()) { ctx.restore(); return; }
+                ctx.translate(4, mid);
+            }
+            ctx.fillText(c[0].substring(0, 12), 0, 4);
+            ctx.restore();
+        }
+    });
+}
+
+function draw() {
+    ctx.clearRect(0, 0, canvas.width, canvas.height);
+    ctx.imageSmoothingEnabled = false;
+    drawTiles(level());
+    ctx.clearRect(0, height(), canvas.width, MARGIN);
+    ctx.clearRect(0, 0, MARGIN, height());
+    drawContigs(M.tcontigs, true);
+    drawContigs(M.qcontigs, false);
+}
+
+function locate(contigs, pos) {
+    var lo = 0, hi = contigs.length - 1;
+    while (lo < hi) {
+        var mid = (lo + hi + 1) >> 1;
+        if (contigs[mid][1] <= pos) { lo = mid; } else { hi = mid - 1; }
+    }
+    if (contigs.length == 0 || pos < 0 || pos > contigs[lo][1] + contigs[lo][2]) { return '-'; }
+    return contigs[lo][0] + ':' + Math.round(pos - contigs[lo][1]).toLocaleString();
+}
+
+var drag = null;
+canvas.addEventListener('mousedown', function (e) { drag = { x: e.clientX, y: e.clientY }; });
+window.addEventListener('mouseup', function () { drag = null; });
+canvas.addEventListener('mousemove', function (e) {
+    if (drag !== null) {
+        view.x0 -= (e.clientX - drag.x) * view.bx;
+        view.y0 += (e.clientY - drag.y) * view.by;
+        drag = { x: e.clientX, y: e.clientY };
+        draw();
+    }
+    var gx = view.x0 + (e.offsetX - MARGIN) * view.bx, gy = view.y0 + (height() - e.offsetY) * view.by;
+    statusBar.textContent = M.reference + ' ' + locate(M.tcontigs, gx) + '    ' + M.query + ' ' + locate(M.qcontigs, gy);
+});
+canvas.addEventListener('wheel', function (e) {
+    e.preventDefault();
+    var f = e.deltaY < 0 ? 0.8 : 1.25;
+    var gx = view.x0 + (e.offsetX - MARGIN) * view.bx, gy = view.y0 + (height() - e.offsetY) * view.by;
+    view.bx *= f;
+    view.by *= f;
+    view.x0 = gx - (e.offsetX - MARGIN) * view.bx;
+    view.y0 = gy - (height() - e.offsetY) * view.by;
+    draw();
+}, { passive: false });
+canvas.addEventListener('dblclick', reset);
+window.addEventListener('resize', resize);
+resize();
+</script>
+</body>
+</html>
+"""
+
+if __name__ == "__main__":
+    args, parser = parse_user_input()
+    main(args, parser)
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+# In-process fasta indexing and cached contig length arrays shared by the pipeline scripts
+import os
+import sys
+import zipfile
+import numpy as np
+
+usage = f'python {sys.argv[0]} <fasta file>'
+
+
+class FastaIndex:
+    """ Columns of a samtools-compatible .fai file as numpy arrays """
+    __slots__ = ('names', 'lengths', 'offsets', 'linebases', 'linewidths')
+
+    def __init__(self, names, lengths, offsets, linebases, linewidths):
+        self.names = names
+        self.lengths = lengths
+        self.offsets = offsets
+        self.linebases = linebases
+        self.linewidths = linewidths
+
+    def __len__(self):
+        return len(self.names)
+
+    def lengthDict(self):
+        return dict(zip(self.names.tolist(), self.lengths.tolist()))
+
+
+def build_fai(fasta, fai=None):
+    """
+    Write a samtools faidx compatible index by streaming through the fasta
+    once, without spawning samtools
+    -----
+    Parameters :
+        fasta : (str) uncompressed fasta file
+        fai : (str) output index file [fasta + '.fai']
+    -----
+    Returns :
+        str : the index file name
+    """
+    fai = fasta + '.fai' if fai is None else fai
+    # Concurrent jobs indexing the same fasta each write their own temporary file
+    tmp = f'{fai}.{os.getpid()}.tmp'
+    try:
+        _write_fai(fasta, tmp)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    os.replace(tmp, fai)
+    return fai
+
+
+def _write_fai(fasta, fai):
+    with open(fasta, 'rb') as input, open(fai, 'w') as out:
+        name = None
+        offset = 0
+        pos = 0
+        length = linebases = linewidth = 0
+        short = False
+        for l in input:
+            if l.startswith(b'>'):
+                if name is not None:
+                    out.write(f'{name}\t{length}\t{offset}\t{linebases}\t{linewidth}\n')
+                segs = l[1:].split()
+                name = segs[0].decode() if len(segs) > 0 else ''
+                pos += len(l)
+                offset = pos
+                length = linebases = linewidth = 0
+                short = False
+            else:
+                bases = len(l.rstrip(b'\r\n'))
+                pos += len(l)
+                if bases == 0:
+                    short = length > 0
+                    continue
+                if short:
+                    raise RuntimeError(f'Different line length in sequence {name} of {fasta}')
+                if linebases == 0:
+                    linebases = bases
+                    # Like samtools, count a terminator even on a last line that lacks one
+                    linewidth = len(l) if len(l) > bases else bases + 1
+                elif bases > linebases:
+                    raise RuntimeError(f'Different line length in sequence {name} of {fasta}')
+                # Only the last line of a sequence may be shorter than the others
+                short = bases < linebases
+                length += bases
+        if name is not None:
+            out.write(f'{name}\t{length}\t{offset}\t{linebases}\t{linewidth}\n')
+
+
+def read_fai(fai):
+    """
+    Load a .fai file as numpy arrays. The arrays are cached in a sidecar
+    .npz file next to the index and reused for as long as the index is
+    unchanged, so large fragmented assemblies are only parsed once.
+    -----
+    Returns :
+        FastaIndex : names, lengths, offsets, linebases and linewidths
+    """
+    cache = fai + '.npz'
+    stat = os.stat(fai)
+    stamp = np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+    if os.path.exists(cache):
+        try:
+            with np.load(cache, allow_pickle=False) as data:
+                if np.array_equal(data['stamp'], stamp):
+                    return FastaIndex(data['names'].astype(str), data['lengths'], data['offsets'],
+                                    data['linebases'], data['linewidths'])
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+            # A truncated or stale sidecar is rebuilt below
+            pass
+
+    names = []
+    cols = [[], [], [], []]
+    with open(fai, 'r') as input:
+        for l in input:
+            s = l.rstrip('\n').split('\t')
+            if len(s) < 5:
+                continue
+            names.append(s[0])
+            for i in range(4):
+                cols[i].append(int(s[i + 1]))
+    names = np.array(names, dtype=str)
+    lengths, offsets, linebases, linewidths = [np.array(c, dtype=np.int64) for c in cols]
+
+    tmp = f'{cache}.{os.getpid()}.tmp'
+    try:
+        with open(tmp, 'wb') as out:
+            np.savez(out, stamp=stamp, names=np.char.encode(names), lengths=lengths,
+                    offsets=offsets, linebases=linebases, linewidths=linewidths)
+        os.replace(tmp, cache)
+    except OSError:
+        # A read-only index location only costs us the cache
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return FastaIndex(names, lengths, offsets, linebases, linewidths)
+
+
+def load_index(fasta):
+    """
+    Index arrays of a fasta file, building its .fai in process if needed
+    """
+    fai = fasta + '.fai'
+    if not os.path.exists(fai) or os.path.getmtime(fai) < os.path.getmtime(fasta):
+        build_fai(fasta, fai)
+    return read_fai(fai)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print(usage)
+        sys.exit(-1)
+
+    index = load_index(sys.argv[1])
+    print(f'Indexed {len(index)} sequences with {index.lengths.sum()} bases')
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+# Single-pass processing of paired fastq files ahead of read alignment
+import os
+import sys
+import io
+import gzip
+import hashlib
+import argparse
+from itertools import chain
+import fasta_index
+
+
+def parse_user_input():
+    parser = argparse.ArgumentParser(
+            description = "Stream paired fastq files once before alignment"
+            )
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    sample = sub.add_parser('subsample',
+            help="Write a deterministic, pair-preserving subsample of reads to a target coverage")
+    sample.add_argument('-f', '--fastq1',
+                        help="First read fastq (gzipped or plain)",
+                        type=str, required=True
+                        )
+    sample.add_argument('-r', '--fastq2',
+                        help="Second read fastq (gzipped or plain)",
+                        type=str, required=True
+                        )
+    sample.add_argument('-o', '--output1',
+                        help="Output gzipped fastq of the first reads",
+                        type=str, required=True
+                        )
+    sample.add_argument('-p', '--output2',
+                        help="Output gzipped fastq of the second reads",
+                        type=str, required=True
+                        )
+    sample.add_argument('-c', '--coverage',
+                        help="Target read coverage of the genome",
+                        type=float, required=True
+                        )
+    sample.add_argument('-g', '--genome_size',
+                        help="Genome size in bp [Default: length of the assembly from -i, or the largest if several are given]",
+                        type=int, default=0
+                        )
+    sample.add_argument('-i', '--fai',
+                        help="Assembly .fai file used for the genome size. Can be repeated",
+                        action="append", default=[]
+                        )
+    sample.add_argument('-s', '--seed',
+                        help="Seed of the read selection hash [0]",
+                        type=int, default=0
+                        )
+    sample.add_argument('-b', '--prefix_bytes',
+                        help="Bytes of each input read before the total read bases are estimated [8000000]",
+                        type=int, default=8000000
+                        )
+
+    split = sub.add_parser('split',
+            help="Deal read pairs round-robin into gzipped chunk files for independent alignment jobs")
+    split.add_argument('-f', '--fastq1',
+                        help="First read fastq (gzipped or plain)",
+                        type=str, required=True
+                        )
+    split.add_argument('-r', '--fastq2',
+                        help="Second read fastq (gzipped or plain)",
+                        type=str, required=True
+                        )
+    split.add_argument('-o', '--output1',
+                        help="Output gzipped fastq of the first reads of a chunk. Repeat once per chunk",
+                        action="append", default=[]
+                        )
+    split.add_argument('-p', '--output2',
+                        help="Output gzipped fastq of the second reads of a chunk, in the same order as -o",
+                        action="append", default=[]
+                        )
+    split.add_argument('-k', '--block',
+                        help="Read pairs written to a chunk before moving to the next one [10000]",
+                        type=int, default=10000
+                        )
+
+    return parser.parse_args(), parser
+
+
+class _CountingReader:
+    """ Raw file wrapper that tracks how many bytes on disk have been consumed """
+
+    def __init__(self, handle):
+        self.handle = handle
+        self.consumed = 0
+
+    def read(self, size=-1):
+        data = self.handle.read(size)
+        self.consumed += len(data)
+        return data
+
+    def __iter__(self):
+        for l in self.handle:
+            self.consumed += len(l)
+            yield l
+
+    def close(self):
+        self.handle.close()
+
+
+class FastqStream:
+    """ Lines of a plain or gzipped fastq, with the compression ratio of what has been read so far """
+
+    def __init__(self, fastq):
+        with open(fastq, 'rb') as fh:
+            gzipped = fh.read(2) == b'\x1f\x8b'
+        self.size = os.path.getsize(fastq)
+        self.raw = _CountingReader(open(fastq, 'rb'))
+        self.gz = gzip.GzipFile(fileobj=self.raw) if gzipped else None
+        # GzipFile.readline is pure Python; a C buffered reader on top splits lines much faster
+        self.lines = io.BufferedReader(self.gz, buffer_size=1 << 20) if gzipped else self.raw
+
+    def decompressed_size(self):
+        """ Estimated size of the whole decompressed file """
+        if self.gz is None or self.raw.consumed == 0:
+            return self.size
+        return self.size * self.gz.tell() / self.raw.consumed
+
+
+def read_pairs(h1, h2):
+    """ Yield the four lines of each read of a pair in lockstep """
+    i1 = iter(h1)
+    i2 = iter(h2)
+    for rec1 in zip(i1, i1, i1, i1):
+        rec2 = (next(i2), next(i2), next(i2), next(i2))
+        if rec1[0][:1] != b'@' or rec2[0][:1] != b'@':
+            raise RuntimeError(f'Malformed fastq record: {rec1[0]!r} {rec2[0]!r}')
+        yield rec1, rec2
+
+
+def read_name(header):
+    """ Read name shared by both mates: the header up to whitespace, without a /1 or /2 suffix """
+    name = header[1:].split(None, 1)[0]
+    if name[-2:] in (b'/1', b'/2'):
+        name = name[:-2]
+    return name
+
+
+def keep_threshold(fraction):
+    return int(min(max(fraction, 0.0), 1.0) * (1 << 64))
+
+
+def selected(name, seed, threshold):
+    """ Keep a pair when the hash of its name falls under the threshold, independent of its position """
+    h = hashlib.blake2b(name, digest_size=8, key=seed.to_bytes(8, 'little'))
+    return int.from_bytes(h.digest(), 'little') < threshold
+
+
+def genome_length(genome_size, fais):
+    if genome_size > 0:
+        return genome_size
+    if len(fais) == 0:
+        raise RuntimeError('Please enter a genome size with -g or at least one assembly .fai with -i!')
+    return max(int(fasta_index.read_fai(f).lengths.sum()) for f in fais)
+
+
+def subsample(args):
+    target = args.coverage * genome_length(args.genome_size, args.fai)
+    s1 = FastqStream(args.fastq1)
+    s2 = FastqStream(args.fastq2)
+    pairs = read_pairs(s1.lines, s2.lines)
+
+    # Records are buffered until enough of both files has been read to estimate their bases per byte
+    prefix = []
+    bases = 0
+    nbytes = 0
+    for rec1, rec2 in pairs:
+        prefix.append((rec1, rec2))
+        bases += len(rec1[1]) + len(rec2[1]) - 2
+        nbytes += sum(map(len, rec1)) + sum(map(len, rec2))
+        if s1.raw.consumed >= args.prefix_bytes and s2.raw.consumed >= args.prefix_bytes:
+            break
+    estimate = bases * (s1.decompressed_size() + s2.decompressed_size()) / nbytes if nbytes > 0 else 0
+    fraction = target / estimate if estimate > 0 else 1.0
+    threshold = keep_threshold(fraction)
+    print(f'Estimated {estimate:.0f} read bases; keeping {min(fraction, 1.0):.4f} of read pairs for {args.coverage}X', file=sys.stderr)
+
+    kept = total = kbases = 0
+    with gzip.open(args.output1, 'wb', compresslevel=1) as o1, gzip.open(args.output2, 'wb', compresslevel=1) as o2:
+        for rec1, rec2 in chain(prefix, pairs):
+            total += 1
+            if selected(read_name(rec1[0]), args.seed, threshold):
+                o1.write(b''.join(rec1))
+                o2.write(b''.join(rec2))
+                kept += 1
+                kbases += len(rec1[1]) + len(rec2[1]) - 2
+    print(f'Kept {kept} of {total} read pairs ({kbases} bases)', file=sys.stderr)
+
+
+def split(args):
+    if len(args.output1) == 0 or len(args.output1) != len(args.output2):
+        raise RuntimeError(f'Please enter the same number of first {len(args.output1)} and second {len(args.output2)} read chunk files!')
+    s1 = FastqStream(args.fastq1)
+    s2 = FastqStream(args.fastq2)
+    outs = [(gzip.open(o1, 'wb', compresslevel=1), gzip.open(o2, 'wb', compresslevel=1))
+            for o1, o2 in zip(args.output1, args.output2)]
+
+    # Blocks go to the chunks in turn, so every chunk gets an even share without knowing the read count
+    blocks = 0
+    buf1 = []
+    buf2 = []
+    for rec1, rec2 in read_pairs(s1.lines, s2.lines):
+        buf1.extend(rec1)
+        buf2.extend(rec2)
+        if len(buf1) == args.block * 4:
+            o1, o2 = outs[blocks % len(outs)]
+            o1.write(b''.join(buf1))
+            o2.write(b''.join(buf2))
+            blocks += 1
+            buf1 = []
+            buf2 = []
+    if len(buf1) > 0:
+        o1, o2 = outs[blocks % len(outs)]
+        o1.write(b''.join(buf1))
+        o2.write(b''.join(buf2))
+        blocks += 1
+    for o1, o2 in outs:
+        o1.close()
+        o2.close()
+    print(f'Split {blocks} blocks of up to {args.block} read pairs into {len(outs)} chunks', file=sys.stderr)
+
+
+def main(args, parser):
+    if args.command == 'subsample':
+        subsample(args)
+    elif args.command == 'split':
+        split(args)
+
+if __name__ == "__main__":
+    args, parser = parse_user_input()
+    main(args, parser)
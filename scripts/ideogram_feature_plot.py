@@ -26,7 +26,7 @@ def parse_user_input():
                         type=str, required=True
                         )
     parser.add_argument('-b', '--bam',
-                        help="Input indexed and sorted bam file",
+                        help="Input indexed and sorted bam or cram file",
                         type=str, required=True
                         )
     parser.add_argument('-t', '--threshold',
@@ -73,7 +73,8 @@ def chromosome_collections(df, y_positions, height,  **kwargs):
 def get_chromosomes_names(input):
 
     # opening the bam file with pysam
-    bamfile = pysam.AlignmentFile(input, 'rb')
+    # Only the header is read, so cram files need no reference
+    bamfile = pysam.AlignmentFile(input, 'r')
     # query all the names of  the chromosomes in a list
     list_chromosomes = bamfile.references
     list_length = bamfile.lengths
@@ -7,7 +7,13 @@ import shutil
 import subprocess as sp
 import argparse
 import logging
+import heapq
+from bisect import bisect_left, bisect_right
+from itertools import accumulate
 from collections import defaultdict, deque
+import numpy as np
+import fasta_index
+import paf_table
 
 
 def parse_user_input():
@@ -42,6 +48,14 @@ def parse_user_input():
                         help="Maximum number of chromosomes to plot per assembly.",
                         required=True, type=int,
                         )
+    parser.add_argument('-g', '--gap',
+                        help="Merge collinear alignments between the same contigs into synteny blocks if they are at most this far apart [-1: do not merge]",
+                        default=-1, type=int,
+                        )
+    parser.add_argument('-e', '--engine',
+                        help="Render with the circos binary or draw the same plot directly with matplotlib [circos]",
+                        default="circos", type=str, choices=["circos", "matplotlib"],
+                        )
     parser.add_argument('-d', '--debug',
                         help="Run in Debug mode",
                         default=False, action='store_true',
@@ -79,6 +93,8 @@ def main(args, parser):
 
     # Now create the Link file
     lFile = LinkFile(kFile.algnDict, cConf.targetList, cConf.corrKey, args.output)
+    if args.gap >= 0:
+        lFile.mergeSyntenyBlocks(args.gap)
     lFile.writeLinks(args.minimum)
 
     # Finally, create the remaining configuration files
@@ -86,8 +102,14 @@ def main(args, parser):
     cConf.createIdeogramFile()
     cConf.createConfFile(kFile.getIdeogramList(), kFile.generateRuleText())
 
-    # Assuming everything worked, try to run circos
-    cConf.run('circos')
+    if args.engine == "matplotlib":
+        # Same layout and colors as the circos configuration, without spawning circos
+        plot = JupiterPlot(args.output)
+        plot.render(cConf.targetList + cConf.queryList, kFile.ideogramList, cConf.getChrOrder(),
+            cConf.getChrOrder()[int(len(cConf.getChrOrder()) / 2):], lFile.links, kFile.getRuleColors())
+    else:
+        # Assuming everything worked, try to run circos
+        cConf.run('circos')
 
 
 class CircosConf:
@@ -155,26 +177,25 @@ class CircosConf:
         for f, t in zip([ref, query], ["REF", "QUERY"]):
             if not os.path.exists(f + '.fai'):
                 logging.info(f'Building fasta index for {t} file: {f}')
-                sp.Popen(f'samtools faidx {f}', shell=True)
-            with open(f + '.fai', 'r') as input:
-                for l in input:
-                    s = l.rstrip().split()
-                    self.corrKey[t][s[0]] = f'av{n}'
+            # Builds the .fai in process (and waits for it) rather than racing a samtools subprocess
+            index = fasta_index.load_index(f)
+            for name, length in zip(index.names.tolist(), index.lengths.tolist()):
+                self.corrKey[t][name] = f'av{n}'
+                if t == "REF":
+                    self.refLenDict[name] = length
+                else:
+                    self.qLenDict[name] = length
+                if len(tempSort[t]) < maxchr:
+                    tempSort[t].append(self.corrKey[t][name])
+                if bedfile == "None":
                     if t == "REF":
-                        self.refLenDict[s[0]] = int(s[1])
+                        color = self.colors[0]
+                        self.colors.rotate(1)
+                        self.targetList.append(Target(name, self.corrKey[t][name], 1, length, color, length))
                     else:
-                        self.qLenDict[s[0]] = int(s[1])
-                    if len(tempSort[t]) < maxchr:
-                        tempSort[t].append(self.corrKey[t][s[0]])
-                    if bedfile == "None":
-                        if t == "REF":
-                            color = self.colors[0]
-                            self.colors.rotate(1)
-                            self.targetList.append(Target(s[0], self.corrKey[t][s[0]], 1, int(s[1]), color, int(s[1])))
-                        else:
-                            color = 'chr10'
-                            self.queryList.append(Target(s[0], self.corrKey[t][s[0]], 1, int(s[1]), color, int(s[1])))
-                    n += 1
+                        color = 'chr10'
+                        self.queryList.append(Target(name, self.corrKey[t][name], 1, length, color, length))
+                n += 1
         tempQuery = tempSort["QUERY"]
         self.chrOrder = list(tempSort["REF"] + tempQuery[::-1])
 
@@ -197,6 +218,44 @@ class LinkFile:
         self.outDir = outDir
 
         self.pairs = []
+        self.links = []
+
+    def mergeSyntenyBlocks(self, gap):
+        """
+        Replace runs of collinear alignments between the same target and
+        query, on the same strand, with one synteny block each so circos
+        draws one ribbon per block rather than one per alignment
+        -----
+        Parameters :
+            gap : (int) largest target and query distance between merged alignments
+        """
+        merged = {}
+        before = 0
+        after = 0
+        for tname, alns in self.algnDict.items():
+            groups = defaultdict(list)
+            for aln in alns:
+                groups[(aln.query, aln.strand)].append(aln)
+            blocks = []
+            for (query, strand), group in groups.items():
+                group.sort(key=lambda aln : aln.T_start)
+                block = None
+                for aln in group:
+                    if block is not None and aln.T_start - block.T_end <= gap and \
+                            ((strand == '+' and -gap <= aln.Q_start - block.Q_end <= gap) or \
+                            (strand == '-' and -gap <= block.Q_start - aln.Q_end <= gap)):
+                        block.T_end = max(block.T_end, aln.T_end)
+                        block.Q_start = min(block.Q_start, aln.Q_start)
+                        block.Q_end = max(block.Q_end, aln.Q_end)
+                        block.length += aln.length
+                        continue
+                    block = Alignment(query, aln.Q_start, aln.Q_end, aln.T_start, aln.T_end, aln.length, strand)
+                    blocks.append(block)
+            merged[tname] = blocks
+            before += len(alns)
+            after += len(blocks)
+        logging.info(f'Merged {before} alignments into {after} synteny blocks')
+        self.algnDict = merged
 
     def _calcMinLen(self):
         llist = []
@@ -206,13 +265,11 @@ class LinkFile:
             llist.extend([x.length for x in self.algnDict[t.name]])
         if len(llist) == 0:
             return None
-        llist.sort(reverse=True)
         logging.debug(len(llist))
-        cutoff = len(llist)
-        if len(llist) >= 500:
-            cutoff = 499
-        logging.info(f'Min sort value {llist[cutoff]}')
-        return llist[cutoff]
+        # Only the 500th longest alignment (or the shortest, if there are fewer) is needed
+        cutoff = heapq.nlargest(500, llist)[-1]
+        logging.info(f'Min sort value {cutoff}')
+        return cutoff
 
     def writeLinks(self, min_align_length):
         if min_align_length == -1:
@@ -237,7 +294,8 @@ class LinkFile:
                     output.write(link1+"\n")
                     link2 = "link{} {} {} {}".format(str(p)+"_"+str(n), self.corrKey["QUERY"][aln.query], aln.Q_start, aln.Q_end)
                     output.write(link2+"\n")
-                    self.pairs.append(Coords(target.name, aln.T_start, aln.T_end, aln.query, aln.Q_start, aln.Q_end))
+                    self.pairs.append(Coords(target.name, aln.query, aln.T_start, aln.Q_start, aln.T_end, aln.Q_end))
+                    self.links.append((target.tag, aln.T_start, aln.T_end, self.corrKey["QUERY"][aln.query], aln.Q_start, aln.Q_end))
 
 
 class KaryotypeFile:
@@ -254,7 +312,8 @@ class KaryotypeFile:
         self.targets_to_plot = set()
         self.names_to_plot = set()
         self.algnDict = {}
-        self.karyotypes = []
+        self.karyotypes = set()
+        self.indices = {}
         self.ideogramList = []
 
     def getTargetList(self):
@@ -273,6 +332,10 @@ class KaryotypeFile:
                     self.names_to_plot.add(t.name)
 
 
+    def getRuleColors(self):
+        """ Link color of every plotted target tag, as set by the rules in generateRuleText """
+        return {t.tag : t.color for t in self.targetList if t.tag in self.targets_to_plot}
+
     def generateRuleText(self):
         text = ''
         for t in self.targetList:
@@ -282,31 +345,21 @@ class KaryotypeFile:
         return text
 
     def readPAF(self, paf, min_align_length):
-        adj_min_len = min_align_length
-        with open(paf, 'r') as input:
-            for l in input:
-                s = l.rstrip().split()
-                if s[5] not in self.names_to_plot:
-                    continue
-                t_len = int(s[6])
-                query = s[0]
-                q_len = int(s[1])
-                q_start = int(s[2])
-                q_end = int(s[3])
-                t_start = int(s[7])
-                t_end = int(s[8])
-                length = int(s[10])
-
-                if int(s[11]) < 10:
-                    continue
-                if min_align_length == -1:
-                    adj_min_len = int(t_len * 0.05)
-                if length <= min_align_length:
-                    continue
-                if s[5] not in self.algnDict.keys() :
-                    self.algnDict[s[5]] = [Alignment(query, q_start, q_end, t_start, t_end, length)]
-                else :
-                    self.algnDict[s[5]].append(Alignment(query, q_start, q_end, t_start, t_end, length))
+        # Filter the whole alignment table at once; uses the binary cache of the PAF when present
+        table = paf_table.load_paf(paf)
+        rec = table.records
+        plotted = np.array([t in self.names_to_plot for t in table.tnames], dtype=bool)
+        keep = plotted[rec['tid']] & (rec['mapq'] >= 10) & (rec['alnlen'] > min_align_length)
+        rec = rec[keep]
+        for tid, qid, q_start, q_end, t_start, t_end, length, rc in zip(rec['tid'].tolist(), rec['qid'].tolist(),
+                rec['qstart'].tolist(), rec['qend'].tolist(), rec['tstart'].tolist(), rec['tend'].tolist(),
+                rec['alnlen'].tolist(), rec['rc'].tolist()):
+            target = table.tnames[tid]
+            aln = Alignment(table.qnames[qid], q_start, q_end, t_start, t_end, length, '-' if rc else '+')
+            if target not in self.algnDict.keys() :
+                self.algnDict[target] = [aln]
+            else :
+                self.algnDict[target].append(aln)
 
     def writeKaryotype(self, min_align_length):
         skips = 0
@@ -322,49 +375,192 @@ class KaryotypeFile:
                     self.ideogramList.append(f'{query.tag}:{query.start}-{query.end}')
             for target in self.targetList:
                 if target not in self.karyotypes:
-                    self.karyotypes.append(target)
+                    self.karyotypes.add(target)
                     displayName = '{:1.20}'.format(target.name)
                     output.write(f'chr - {target.tag} {displayName} 0 {target.length} {target.color}\n')
                 else:
                     continue
 
-                queries_aligned = []
                 if target.name not in self.algnDict.keys():
                     continue
-                for aln in self.algnDict[target.name]:
-                    lines += 1
-                    if aln.length < min_align_length :
-                        skips += 1
-                        continue
-                    #
-                    #   =========    target region
-                    # -------------- query region
-                    #
-                    elif (aln.T_start <= target.start and aln.T_end >= target.end) :
-                        queries_aligned.append(aln.query)
-
-                    #
-                    #   =========    target region
-                    # ----- or ----- query region
-                    #
-                    elif (aln.T_start <= target.start and aln.T_end > target.start and aln.T_end <= target.end) or (aln.T_start >= target.start and aln.T_start <= target.end and aln.T_end >= target.end) :
-                        queries_aligned.append(aln.query)
-                        #print(aln.T_start, aln.T_end) # DEBUG
-
-                    #
-                    #   ========= target region
-                    #     ----    query region
-                    #
-                    elif (aln.T_start >= target.start and aln.T_end <= target.end) :
-                        queries_aligned.append(aln.query)
-                    else :
-                        #print(aln.T_start, aln.T_end) # DEBUG
-                        continue
+                index = self.indices.get(target.name)
+                if index is None:
+                    index = AlignmentIndex(self.algnDict[target.name], min_align_length)
+                    self.indices[target.name] = index
+                lines += len(self.algnDict[target.name])
+                skips += index.skipped
+
+                # Alignments that cover, overhang or sit within the target region
+                queries_aligned = [aln.query for aln in index.overlapping(target.start, target.end)]
                 self.ideogramList.append(f'{target.tag}:{target.start}-{target.end}')
-                logging.debug(f'Skipped {skips} out of {lines} lines in alignment of target {target.name}')
+                logging.debug(f'Skipped {skips} out of {lines} lines in alignment of target {target.name}; {len(queries_aligned)} overlap the target region')
+
+
+class AlignmentIndex :
+    """ Alignments of one target sorted by start for overlap queries against target regions """
+    __slots__ = ('alns', 'starts', 'maxends', 'skipped')
+
+    def __init__(self, alns, min_align_length) :
+        kept = [aln for aln in alns if aln.length >= min_align_length]
+        self.skipped = len(alns) - len(kept)
+        self.alns = sorted(kept, key=lambda aln : aln.T_start)
+        self.starts = [aln.T_start for aln in self.alns]
+        # Running maximum of the end coordinates lets whole runs of earlier alignments be skipped
+        self.maxends = list(accumulate([aln.T_end for aln in self.alns], max))
+
+    def overlapping(self, start, end) :
+        """
+        Alignments that span the region, overhang either of its ends or lie
+        within it
+        """
+        lo = bisect_left(self.starts, start)
+        hi = bisect_right(self.starts, end)
+        # Alignments that start before the region must reach into it
+        reach = min(start + 1, end)
+        first = bisect_left(self.maxends, reach, 0, lo)
+        hits = [aln for aln in self.alns[first:lo] if aln.T_end >= reach]
+        hits.extend(self.alns[lo:hi])
+        return hits
+
+
+class JupiterPlot :
+    """ Draws the Jupiter-style ribbon plot of the circos configuration directly with matplotlib """
+
+    # Ideogram and link geometry from the IDEOGRAM, TICKS and CIRCOS templates
+    RADIUS = 0.725
+    THICKNESS = 0.04
+    SPACING = 0.005
+    TICK_SPACING = 1000000
 
+    def __init__(self, outDir):
+        self.outDir = outDir
+
+    def _layout(self, ideograms, chrOrder):
+        regions = {}
+        for i in ideograms:
+            tag, span = i.split(':')
+            start, end = span.split('-')
+            regions[tag] = (int(start), int(end))
+        order = [t for t in chrOrder if t in regions]
+        order.extend([t for t in regions if t not in set(order)])
+        return regions, order
+
+    def render(self, karyotypes, ideograms, chrOrder, reverses, links, ruleColors, name='circos.png'):
+        """
+        Draw ideograms and link ribbons and save the image in the output directory
+        -----
+        Parameters :
+            karyotypes : (list) Target entries of the karyotype file
+            ideograms : (list) displayed regions as tag:start-end
+            chrOrder : (list) ideogram tags in display order
+            reverses : (list) ideogram tags drawn in reverse orientation
+            links : (list) (tag, start, end, tag, start, end) link ends from LinkFile
+            ruleColors : (dict) link color of each target tag
+        """
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+        from matplotlib.collections import LineCollection, PatchCollection
+        from matplotlib.patches import PathPatch, Wedge
+        from matplotlib.path import Path
+        import numpy as np
+
+        names = {k.tag : k for k in karyotypes}
+        regions, order = self._layout(ideograms, chrOrder)
+        reverses = set(reverses)
+        total = sum(e - s for s, e in regions.values())
+        if len(order) == 0 or total <= 0:
+            logging.info('No ideograms to draw!')
+            return
+        # Circos runs clockwise from the top of the circle
+        gap = 2 * np.pi * self.SPACING
+        scale = (2 * np.pi - gap * len(order)) / total
+        offsets = {}
+        angle = 0.0
+        for tag in order:
+            offsets[tag] = angle
+            angle += (regions[tag][1] - regions[tag][0]) * scale + gap
+
+        def theta(tag, pos):
+            s, e = regions[tag]
+            pos = min(max(pos, s), e)
+            return offsets[tag] + ((e - pos) if tag in reverses else (pos - s)) * scale
+
+        def point(t, r):
+            return r * np.sin(t), r * np.cos(t)
+
+        def arc(t1, t2, r):
+            t = np.linspace(t1, t2, max(2, int(abs(t2 - t1) / 0.01)))
+            return np.column_stack(point(t, r))
+
+        fig, ax = plt.subplots(figsize=(10, 10))
+        inner = self.RADIUS - self.THICKNESS
+
+        # Ideograms, their ticks and labels
+        wedges = []
+        colors = []
+        ticks = []
+        for tag in order:
+            s, e = regions[tag]
+            t1, t2 = offsets[tag], offsets[tag] + (e - s) * scale
+            wedges.append(Wedge((0, 0), self.RADIUS, 90 - np.degrees(t2), 90 - np.degrees(t1), width=self.THICKNESS))
+            colors.append(circosColor(names[tag].color if tag in names else 'dgrey'))
+            for pos in range(-(-s // self.TICK_SPACING) * self.TICK_SPACING, e + 1, self.TICK_SPACING):
+                t = theta(tag, pos)
+                ticks.append([point(t, self.RADIUS), point(t, self.RADIUS + 0.012)])
+            mid = (t1 + t2) / 2
+            x, y = point(mid, self.RADIUS * 1.02 + 0.02)
+            label = '{:1.20}'.format(names[tag].name) if tag in names else tag
+            ax.text(x, y, label, fontsize=8, rotation=90 - np.degrees(mid) if np.sin(mid) >= 0 else 270 - np.degrees(mid),
+                ha='left' if np.sin(mid) >= 0 else 'right', va='center', rotation_mode='anchor')
+        ax.add_collection(PatchCollection(wedges, facecolor=colors, edgecolor='#555555', linewidth=1))
+        ax.add_collection(LineCollection(ticks, colors='black', linewidths=0.5))
+
+        # Ribbons with bezier sides pulled through the center of the circle
+        ribbons = []
+        rcolors = []
+        for tag1, s1, e1, tag2, s2, e2 in links:
+            if tag1 not in regions or tag2 not in regions:
+                continue
+            if e1 < regions[tag1][0] or s1 > regions[tag1][1] or e2 < regions[tag2][0] or s2 > regions[tag2][1]:
+                continue
+            a = arc(theta(tag1, s1), theta(tag1, e1), inner)
+            b = arc(theta(tag2, s2), theta(tag2, e2), inner)
+            verts = np.concatenate([a, [(0, 0)], b, [(0, 0)], a[:1]])
+            codes = [Path.MOVETO] + [Path.LINETO] * (len(a) - 1) + [Path.CURVE3, Path.CURVE3] + \
+                [Path.LINETO] * (len(b) - 1) + [Path.CURVE3, Path.CURVE3]
+            ribbons.append(PathPatch(Path(verts, codes)))
+            rcolors.append(circosColor(ruleColors.get(tag1, 'purple_a2')))
+        ax.add_collection(PatchCollection(ribbons, facecolor=rcolors, edgecolor='black', linewidth=0.2, alpha=0.7))
+
+        ax.set_xlim(-1, 1)
+        ax.set_ylim(-1, 1)
+        ax.set_aspect('equal')
+        ax.axis('off')
+        fig.savefig(os.path.join(self.outDir, name), dpi=300, bbox_inches='tight')
+        plt.close(fig)
+        logging.info(f'Drew {len(ribbons)} links on {len(order)} ideograms')
+
+# RGB values of the circos named colors used by the configuration
+CIRCOS_COLORS = {
+    'chr1' : (153, 102, 0), 'chr2' : (102, 102, 0), 'chr3' : (153, 153, 30), 'chr4' : (204, 0, 0),
+    'chr5' : (255, 0, 0), 'chr6' : (255, 0, 204), 'chr7' : (255, 204, 204), 'chr8' : (255, 153, 0),
+    'chr9' : (255, 204, 0), 'chr10' : (255, 255, 0), 'chr11' : (204, 255, 0), 'chr12' : (0, 255, 0),
+    'chr13' : (53, 128, 0), 'chr14' : (0, 0, 204), 'chr15' : (102, 153, 255), 'chr16' : (153, 204, 255),
+    'chr17' : (0, 255, 255), 'chr18' : (204, 255, 255), 'chr19' : (153, 0, 204), 'chr20' : (204, 51, 255),
+    'chr21' : (204, 153, 255), 'chr22' : (102, 102, 102), 'chr23' : (153, 153, 153),
+    'purple_a2' : (106, 61, 154), 'dgrey' : (85, 85, 85),
+}
+
+def circosColor(name):
+    """ Matplotlib color of a circos color name; unknown names are passed through """
+    if name in CIRCOS_COLORS:
+        return tuple(c / 255 for c in CIRCOS_COLORS[name])
+    return name
 
 class Target :
+    __slots__ = ('name', 'tag', 'start', 'end', 'color', 'length')
+
     def __init__(self, name, tag, start, end, color, length) :
         """ """
         self.name = name
@@ -378,6 +574,8 @@ class Target :
         return "Target(name={}, tag={}, start={}, end={}, color={}, length={})".format(self.name,self.tag,self.start,self.end,self.color,self.length)
 
 class Coords :
+    __slots__ = ('n1', 's1', 'e1', 'n2', 's2', 'e2')
+
     def __init__(self, name_1, name_2, start_1, start_2, end_1, end_2) :
         """ """
         self.n1 = name_1
@@ -392,13 +590,16 @@ class Coords :
 
 class Alignment :
     """ """
-    def __init__(self, query, Q_start, Q_end, T_start, T_end, length) :
+    __slots__ = ('query', 'Q_start', 'Q_end', 'T_start', 'T_end', 'length', 'strand')
+
+    def __init__(self, query, Q_start, Q_end, T_start, T_end, length, strand='+') :
         self.query = query
         self.Q_start = Q_start
         self.Q_end = Q_end
         self.T_start = T_start
         self.T_end = T_end
         self.length = length
+        self.strand = strand
 
 
 IDEOGRAM = """
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+# Columnar PAF loading shared by the alignment comparison scripts
+import os
+import sys
+from itertools import groupby
+import numpy as np
+
+usage = f'python {sys.argv[0]} <paf file>'
+
+# Fixed-width numeric columns of a PAF record; sequence names are interned
+# into the qnames/tnames tables and referenced by index
+PAF_DTYPE = np.dtype([
+    ('qid', '<i4'),
+    ('qlen', '<i8'),
+    ('qstart', '<i8'),
+    ('qend', '<i8'),
+    ('rc', '?'),
+    ('tid', '<i4'),
+    ('tlen', '<i8'),
+    ('tstart', '<i8'),
+    ('tend', '<i8'),
+    ('matches', '<i8'),
+    ('alnlen', '<i8'),
+    ('mapq', '<i2'),
+])
+
+
+class PafTable:
+    """ PAF alignments as a numpy structured array plus interned name tables """
+    __slots__ = ('records', 'qnames', 'tnames')
+
+    def __init__(self, records, qnames, tnames):
+        self.records = records
+        self.qnames = qnames
+        self.tnames = tnames
+
+    def __len__(self):
+        return len(self.records)
+
+    def qrank(self):
+        """ Sort rank of every query name, indexed by qid """
+        return _name_rank(self.qnames)
+
+    def trank(self):
+        """ Sort rank of every target name, indexed by tid """
+        return _name_rank(self.tnames)
+
+
+def _name_rank(names):
+    rank = np.empty(len(names), dtype=np.int64)
+    rank[np.argsort(np.asarray(names, dtype=str), kind='stable')] = np.arange(len(names))
+    return rank
+
+
+class _Interner:
+    """ Assigns names consecutive ids in the order they are first seen """
+
+    def __init__(self):
+        self.ids = dict()
+        self.names = []
+
+    def __call__(self, name):
+        i = self.ids.get(name)
+        if i is None:
+            i = len(self.names)
+            self.ids[name] = i
+            self.names.append(name)
+        return i
+
+
+def parse_records(lines, qintern, tintern):
+    """
+    Parse PAF text lines into a structured array. Lines with fewer than
+    the 12 mandatory PAF columns are skipped.
+    """
+    qids = []
+    tids = []
+    strands = []
+    nums = []
+    for l in lines:
+        # Optional SAM-like tags after the mandatory columns are never split apart
+        s = l.split(None, 12)
+        if len(s) < 12:
+            continue
+        qids.append(qintern(s[0]))
+        tids.append(tintern(s[5]))
+        strands.append(s[4])
+        nums.extend(s[1:4])
+        nums.extend(s[6:12])
+
+    # Integer conversion of all numeric columns in one pass through numpy's parser
+    cols = np.fromstring(' '.join(nums), dtype=np.int64, sep=' ').reshape(-1, 9)
+    records = np.zeros(len(qids), dtype=PAF_DTYPE)
+    records['qid'] = qids
+    records['tid'] = tids
+    records['rc'] = np.array(strands, dtype=str) == '-'
+    for i, f in enumerate(('qlen', 'qstart', 'qend', 'tlen', 'tstart', 'tend', 'matches', 'alnlen', 'mapq')):
+        records[f] = cols[:, i]
+    return records
+
+
+def read_paf(input):
+    """
+    Load a PAF file into a PafTable
+    -----
+    Parameters :
+        input : (str or file) PAF file name or an open text handle
+    -----
+    Returns :
+        PafTable : the alignments in file order
+    """
+    qintern = _Interner()
+    tintern = _Interner()
+    if isinstance(input, str):
+        with open(input, 'r') as paf:
+            records = parse_records(paf, qintern, tintern)
+    else:
+        records = parse_records(input, qintern, tintern)
+    return PafTable(records, qintern.names, tintern.names)
+
+
+def cache_files(paf):
+    """ Names of the binary cache files kept next to a PAF: records, query names and target names """
+    return paf + '.npy', paf + '.qnames.npy', paf + '.tnames.npy'
+
+
+def save_cache(table, paf):
+    """
+    Write a PafTable as a binary cache next to its PAF file. The records are
+    a plain .npy array that load_cache memory maps without parsing or copying.
+    -----
+    Returns :
+        tuple : the cache file names from cache_files
+    """
+    files = cache_files(paf)
+    arrays = (table.records, np.char.encode(np.asarray(table.qnames, dtype=str)),
+        np.char.encode(np.asarray(table.tnames, dtype=str)))
+    for f, a in zip(files, arrays):
+        # Write via np.save on a handle so the name does not get a second .npy suffix
+        with open(f + '.tmp', 'wb') as out:
+            np.save(out, a, allow_pickle=False)
+        os.replace(f + '.tmp', f)
+    return files
+
+
+def load_cache(paf, mmap=True):
+    """
+    Load the binary cache of a PAF file written by save_cache
+    -----
+    Parameters :
+        paf : (str) PAF file name the cache was built from
+        mmap : (bool) memory map the records read-only instead of reading them
+    -----
+    Returns :
+        PafTable : the alignments in file order
+    """
+    records, qnames, tnames = cache_files(paf)
+    return PafTable(np.load(records, mmap_mode='r' if mmap else None, allow_pickle=False),
+        np.load(qnames, allow_pickle=False).astype(str).tolist(),
+        np.load(tnames, allow_pickle=False).astype(str).tolist())
+
+
+def load_paf(paf, mmap=True):
+    """
+    Load a PAF file from its binary cache if one is present and up to date,
+    parsing the text otherwise
+    """
+    files = cache_files(paf)
+    if os.path.exists(paf) and all(os.path.exists(f) for f in files) and \
+            min(os.path.getmtime(f) for f in files) >= os.path.getmtime(paf):
+        return load_cache(paf, mmap)
+    return read_paf(paf)
+
+
+def _query_name(line):
+    s = line.split(None, 1)
+    return s[0] if len(s) > 0 else ''
+
+
+def iter_query_batches(input, batch=65536):
+    """
+    Stream a query-grouped PAF (minimap2 output order, or a file sorted by
+    query name) as a series of PafTables. Every table holds only complete
+    query blocks and its own name tables, so memory is bounded by the batch
+    size or the largest query block, whichever is greater, however many
+    queries the file has. A query repeated within one batch is reported as
+    ungrouped input; repeats further apart than a batch cannot be detected
+    in bounded memory.
+    -----
+    Parameters :
+        input : (file) open PAF text handle, e.g. sys.stdin
+        batch : (int) minimum number of lines per yielded table
+    -----
+    Returns :
+        generator : PafTable for each batch of query blocks, in input order
+    """
+    seen = set()
+    pending = []
+    for qname, lines in groupby(input, key=_query_name):
+        if qname != '':
+            if qname in seen:
+                raise RuntimeError(f'Query {qname} appears in more than one block; the PAF must be grouped by query (sort -k1,1)')
+            seen.add(qname)
+        pending.extend(lines)
+        if len(pending) >= batch:
+            yield _batch_table(pending)
+            seen = set()
+            pending = []
+    if len(pending) > 0:
+        yield _batch_table(pending)
+
+
+def _batch_table(lines):
+    # Fresh name tables per batch keep ids small and drop the names of finished queries
+    qintern = _Interner()
+    tintern = _Interner()
+    return PafTable(parse_records(lines, qintern, tintern), qintern.names, tintern.names)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print(usage)
+        sys.exit(-1)
+
+    table = read_paf(sys.argv[1])
+    save_cache(table, sys.argv[1])
+    print(f'Cached {len(table)} alignments with {len(table.qnames)} query and {len(table.tnames)} target sequences')
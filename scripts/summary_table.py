@@ -84,6 +84,7 @@ for i in snakemake.input["snpqv"]:
 
 for i in snakemake.input["bams"]:
     print(f'pysam:{i}')
+    # Cram indices hold no counts, but samtools then counts from the flag column without decoding sequences
     text = pysam.idxstats(i)
     lines = text.split(sep="\n")
     mapped = 0
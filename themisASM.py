@@ -3,6 +3,9 @@
 import sys
 import argparse
 import os
+import re
+import json
+import itertools
 import logging
 import subprocess as sp
 
@@ -24,8 +27,8 @@ def parse_user_input():
                         action="append", default=[]
                         )
     parser.add_argument('-b', '--busco',
-                        help="The name of the BUSCO database to use for assessment",
-                        type=str, required=True
+                        help="The name of the BUSCO database to use for assessment [Required unless --add is given]",
+                        type=str, default=None
                         )
     parser.add_argument('-f', '--fastq',
                         help="Paired short read fastqs separated by commas.",
@@ -35,6 +38,62 @@ def parse_user_input():
                         help="A sample name for the fastqs provided. Add in the order in which the fastq files are specified",
                         action="append", default=[]
                         )
+    parser.add_argument('-d', '--depth_mode',
+                        help="Count exact read depth or estimate it from a sample of windows for quick-look runs [Default: exact]",
+                        type=str, choices=["exact", "approx"], default="exact"
+                        )
+    parser.add_argument('-g', '--genome_size',
+                        help="Expected genome size in bp for NG(x) statistics [Default: length of the largest assembly]",
+                        type=int, default=0
+                        )
+    parser.add_argument('-S', '--subsample_coverage',
+                        help="Align a deterministic subsample of the reads to this coverage for quick-look runs [Default: 0, use all reads]",
+                        type=float, default=0
+                        )
+    parser.add_argument('-k', '--align_chunks',
+                        help="Split every read pair into this many chunks that are aligned as separate cluster jobs [Default: 1]",
+                        type=int, default=1
+                        )
+    parser.add_argument('-F', '--alignment_format',
+                        help="Keep merged read alignments as bam or as smaller, reference-compressed cram files [Default: bam]",
+                        type=str, choices=["bam", "cram"], default="bam"
+                        )
+    parser.add_argument('-m', '--comparison_mode',
+                        help="Align every pair of assemblies, every assembly to one reference (-R) or only chosen pairs (-P) [Default: all]",
+                        type=str, choices=["all", "reference", "pairs"], default="all"
+                        )
+    parser.add_argument('-R', '--comparison_reference',
+                        help="Assembly name that all others are aligned to in reference comparison mode [Default: first assembly]",
+                        type=str, default=None
+                        )
+    parser.add_argument('-P', '--comparison_pair',
+                        help="A pair of assembly names separated by a comma (reference first) for pairs comparison mode. Can be repeated",
+                        action="append", default=[]
+                        )
+    parser.add_argument('--dotplot_engine',
+                        help="Draw dotplots with the binned numpy renderer or the original pafDotPlotly.R script [Default: binned]",
+                        type=str, choices=["binned", "plotly"], default="binned"
+                        )
+    parser.add_argument('--circos_engine',
+                        help="Draw the Jupiter circos plots in python with matplotlib or with the Circos program [Default: circos]",
+                        type=str, choices=["matplotlib", "circos"], default="circos"
+                        )
+    parser.add_argument('--synteny_gap',
+                        help="Merge collinear alignments closer than this many bp into one circos synteny block; -1 draws every alignment [Default: 100000]",
+                        type=int, default=100000
+                        )
+    parser.add_argument('-p', '--pair_jobs',
+                        help="Call between-alignment variants in a separate job for each assembly pair instead of one batch job [Flag]",
+                        action="store_true", default=False
+                        )
+    parser.add_argument('-x', '--cache_dir',
+                        help="Directory shared between runs that caches indices, merqury, busco and alignment results of unchanged inputs [Default: no cache]",
+                        type=str, default=None
+                        )
+    parser.add_argument('-A', '--add',
+                        help="Add the assemblies given with -a/-n to the default.json of a finished run, so only their jobs, their new pairs and the combined summaries are computed [Flag]",
+                        action="store_true", default=False
+                        )
     parser.add_argument('-c', '--cluster_string',
                         help="A short formatted string for instructions on how to submit to your cluster [Default: do not submit to cluster]",
                         type=str, default=None
@@ -62,9 +121,12 @@ def main(args, parser):
         LOG.error(inst.args)
         sys.exit()
 
-    # Create the config file
+    # Create the config file, or extend the existing one
     try:
-        createConfig(args)
+        if args.add:
+            oldPairs = addToConfig(args)
+        else:
+            createConfig(args)
     except RuntimeError as inst:
         LOG.error(inst.args)
         sys.exit()
@@ -72,6 +134,14 @@ def main(args, parser):
     # Generate the command
     cmd = createSNKCmd(args)
 
+    # Adding assemblies must never recompute the pairs of the previous run
+    if args.add:
+        try:
+            checkAddDryRun(cmd, oldPairs)
+        except RuntimeError as inst:
+            LOG.error(inst.args)
+            sys.exit()
+
     # Now attempt to run it!
     try:
         LOG.info("Trying to run the snakemake job in this scrpt... wish me luck!")
@@ -99,18 +169,51 @@ def validate(args):
     if len(args.sample) != len(args.fastq):
         raise RuntimeError(f'Please enter the same count of read fastqs {len(args.fastq)} as your sample names {len(args.sample)}')
 
+    if args.add:
+        if len(args.assembly) == 0:
+            raise RuntimeError('Please enter at least one new assembly with -a and -n to add!')
+        if len(args.fastq) > 0:
+            raise RuntimeError('New reads change the results of every assembly; please start a new run instead of adding samples!')
+    elif args.busco is None:
+        raise RuntimeError('Please enter the name of a BUSCO database with -b!')
+
+    if args.comparison_mode == "reference" and args.comparison_reference is not None and args.comparison_reference not in args.name:
+        raise RuntimeError(f'The comparison reference {args.comparison_reference} must be one of the assembly names!')
+    if args.comparison_mode == "pairs" and not args.add:
+        if len(args.comparison_pair) == 0:
+            raise RuntimeError('Please enter at least one assembly pair with -P in pairs comparison mode!')
+        for p in args.comparison_pair:
+            pseg = p.split(',')
+            if len(pseg) != 2 or pseg[0] not in args.name or pseg[1] not in args.name or pseg[0] == pseg[1]:
+                raise RuntimeError(f'Comparison pair {p} must be two different assembly names separated by a comma!')
+
     rdir = os.path.join(os.getcwd(), '.snakemake')
-    if os.path.isdir(rdir) and not args.resume:
+    if os.path.isdir(rdir) and not args.resume and not args.add:
         raise RuntimeError("It looks like you've already run snakemake in this directory -- please remove or resume your job!")
     ldir = os.path.join(rdir, 'locks')
     if os.path.isdir(ldir) and os.listdir(ldir):
         raise RuntimeError("It looks like the directory is locked by Snakemake. Please run an unlock job first with --unlock!")
 
 def createConfig(args):
-    config = f'{{\n  "buscoLineage" : "{args.busco}",\n  "assembly" : {{\n';
+    config = f'{{\n  "buscoLineage" : "{args.busco}",\n  "depthMode" : "{args.depth_mode}",\n  "genomeSize" : {args.genome_size},\n  "variantBatch" : {str(not args.pair_jobs).lower()},\n  "dotplotEngine" : "{args.dotplot_engine}",\n  "circosEngine" : "{args.circos_engine}",\n  "syntenyGap" : {args.synteny_gap},\n  "comparisonMode" : "{args.comparison_mode}",\n  "assembly" : {{\n';
     for aname, afile in zip(args.name, args.assembly):
         config += f'    "{aname}" : "{afile}",\n'
-    config += "  },\n  \"samples\" : {\n"
+    config += "  },\n"
+    if args.comparison_mode == "reference":
+        ref = args.comparison_reference if args.comparison_reference is not None else args.name[0]
+        config += f'  "comparisonReference" : "{ref}",\n'
+    elif args.comparison_mode == "pairs":
+        pairs = ', '.join([f'["{p.split(",")[0]}", "{p.split(",")[1]}"]' for p in args.comparison_pair])
+        config += f'  "comparisonPairs" : [{pairs}],\n'
+    if args.subsample_coverage > 0:
+        config += f'  "subsampleCoverage" : {args.subsample_coverage},\n'
+    if args.align_chunks > 1:
+        config += f'  "alignChunks" : {args.align_chunks},\n'
+    if args.alignment_format != "bam":
+        config += f'  "alignmentFormat" : "{args.alignment_format}",\n'
+    if args.cache_dir is not None:
+        config += f'  "cacheDir" : "{os.path.abspath(args.cache_dir)}",\n'
+    config += "  \"samples\" : {\n"
 
     for sname, fqstr in zip(args.sample, args.fastq):
         fqseg = fqstr.split(',')
@@ -123,6 +226,105 @@ def createConfig(args):
         co.write(config)
     LOG.info("Created new configuration file: default.json")
 
+def readConfig(cfile):
+    with open(cfile) as fh:
+        text = fh.read()
+    try:
+        return json.loads(text)
+    except ValueError:
+        # Configs written by createConfig have trailing commas, which YAML (and snakemake) accept
+        import yaml
+        return yaml.safe_load(text)
+
+def comparisonPairs(config):
+    """ Names of the assembly pairs compared by a config, in the same order as pcombis in the themisSnakefile """
+    asmNames = list(config["assembly"].keys())
+    if len(asmNames) < 2:
+        return []
+    compMode = config.get("comparisonMode", "all")
+    if compMode == "reference":
+        compRef = config.get("comparisonReference", asmNames[0])
+        return [compRef + "_" + a for a in asmNames if a != compRef]
+    elif compMode == "pairs":
+        return [p[0] + "_" + p[1] for p in config.get("comparisonPairs", [])]
+    return [c[0] + "_" + c[1] for c in itertools.combinations(asmNames, 2)]
+
+def addToConfig(args):
+    """
+    Merge new assemblies into the default.json of a previous run. Assemblies are appended
+    so every existing pair keeps its name and its results are reused by snakemake
+    -----
+    Parameters :
+        args : (argparse.Namespace) parsed arguments with the new assemblies, pairs and cache directory
+    -----
+    Returns :
+        list : names of the pairs compared before the new assemblies were added
+    """
+    if not os.path.isfile("default.json"):
+        raise RuntimeError("Could not find a default.json in this directory to add assemblies to!")
+    config = readConfig("default.json")
+    oldPairs = comparisonPairs(config)
+
+    # The batched SV job keeps only the pairs it already called; new pairs get their own jobs,
+    # so its outputs, and every plot made from them, are not rewritten
+    if config.get("variantBatch", False) and "variantBatchPairs" not in config:
+        config["variantBatchPairs"] = oldPairs
+
+    for aname, afile in zip(args.name, args.assembly):
+        if aname in config["assembly"]:
+            raise RuntimeError(f'Assembly name {aname} is already part of this run!')
+        config["assembly"][aname] = afile
+
+    if config.get("comparisonMode", "all") == "pairs":
+        pairs = config.get("comparisonPairs", [])
+        for p in args.comparison_pair:
+            pseg = p.split(',')
+            if len(pseg) != 2 or pseg[0] not in config["assembly"] or pseg[1] not in config["assembly"] or pseg[0] == pseg[1]:
+                raise RuntimeError(f'Comparison pair {p} must be two different assembly names separated by a comma!')
+            pairs.append(pseg)
+        if len(args.comparison_pair) == 0:
+            LOG.warning("No new pairs were given with -P; the new assemblies will not be aligned to any other assembly")
+        config["comparisonPairs"] = pairs
+    if args.cache_dir is not None:
+        config["cacheDir"] = os.path.abspath(args.cache_dir)
+
+    with open("default.json", 'w') as co:
+        json.dump(config, co, indent=2)
+        co.write("\n")
+    LOG.info(f'Added {", ".join(args.name)} to configuration file: default.json')
+    return oldPairs
+
+def pairOfOutput(path):
+    """ Name of the assembly pair a workflow output belongs to, or None for per-assembly and combined outputs """
+    m = re.match(r'(?:final/([^/]+)/|mapped/map(.+?)\.paf(?:\.|$)|calls/vars(.+?)\.paf$)', path)
+    if m is None:
+        return None
+    return next(g for g in m.groups() if g is not None)
+
+def checkAddDryRun(cmd, oldPairs):
+    """
+    Dry run the workflow after an --add and refuse to start it if any job would write results
+    of a pair that was already compared
+    -----
+    Parameters :
+        cmd : (str) snakemake command of the run
+        oldPairs : (list) names of the pairs compared before the new assemblies were added
+    """
+    LOG.info("Checking with a dry run that no existing assembly pair is recomputed")
+    dry = sp.run(cmd + " --dry-run", shell=True, check=True, stdout=sp.PIPE, stderr=sp.STDOUT, universal_newlines=True)
+    old = set(oldPairs)
+    redone = set()
+    for l in dry.stdout.split('\n'):
+        l = l.strip()
+        if not l.startswith("output:"):
+            continue
+        for o in l[len("output:"):].split(','):
+            pair = pairOfOutput(o.strip())
+            if pair in old:
+                redone.add(pair)
+    if len(redone) > 0:
+        raise RuntimeError(f'The dry run would recompute the existing pairs {", ".join(sorted(redone))}! default.json was updated; run the snakemake command above yourself if this is intended')
+
 if __name__ == "__main__":
     args, parser = parse_user_input()
     main(args, parser)